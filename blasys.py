@@ -1,5 +1,7 @@
 from utils.greedyWorker import GreedyWorker
 from utils.banner import print_banner
+from utils.cache import FactorCache
+from utils import toolcache
 import yaml
 import argparse
 import os
@@ -33,12 +35,34 @@ def main():
     parser.add_argument('-m', '--metric', help='Choose error metric', dest='metric', default='HD')
     parser.add_argument('-tr', '--track', help='Number of tracks in greedy search', dest='track', type=int, default=3)
     parser.add_argument('-cpu', '--cpu_count', help='Specify number of CPU in parallel mode', dest='cpu', type=int, default=-1)
+    parser.add_argument('--max_part_inputs', help='Maximum number of inputs per partition; partitions above 16 inputs are factorized on sampled input vectors', dest='max_part_inputs', type=int, default=16)
+    parser.add_argument('--sample_size', help='Number of sampled input vectors per partition above 16 inputs', dest='sample_size', type=int, default=4096)
+    parser.add_argument('--sample_mode', help='Sampling of input vectors for partitions above 16 inputs', dest='sample_mode', choices=['random', 'stratified'], default='random')
+    parser.add_argument('--bmf_sweep', help='Threshold sweep inside BMF', dest='bmf_sweep', choices=['full', 'parallel', 'adaptive'], default='full')
+    parser.add_argument('--bmf_cpu', help='Number of CPU used by the parallel BMF sweep', dest='bmf_cpu', type=int, default=None)
+    parser.add_argument('--bmf_backend', help='Truth-table engine used by BMF', dest='bmf_backend', choices=['dense', 'packed'], default='dense')
     
     # Flags 
     parser.add_argument('--parallel', help='Run the flow in parallel mode if specified', dest='parallel', action='store_true')
     parser.add_argument('--no_partition', help='Factorize without partition', dest='single', action='store_true')
     parser.add_argument('--sta', help='Use OpenSTA to estimate power and delay', dest='sta', action='store_true')
     parser.add_argument('--fast_random', help='Accelerate by randomly picking subcircuits to approximate', dest='rand', action='store_true')
+    parser.add_argument('--w_synth', help='Synthesis of the W functions of each partition', dest='w_synth', choices=['abc', 'isop'], default='abc')
+    parser.add_argument('--simulator', help='Simulator of candidate designs', dest='simulator', choices=['numpy', 'lut', 'iverilog'], default='iverilog')
+    parser.add_argument('--truth_format', help='Format of the truth tables on disk', dest='truth_format', choices=['text', 'binary'], default='text')
+    parser.add_argument('--cache', help='Directory of the factorization cache shared across runs', dest='cache', default=None)
+    parser.add_argument('--cache_size', help='Size limit of the factorization cache in MB', dest='cache_size', type=int, default=1024)
+    parser.add_argument('--tool_cache', help='Directory of the cache of yosys, ABC, iverilog and OpenSTA runs shared across runs', dest='tool_cache', default=None)
+    parser.add_argument('--tool_cache_size', help='Size limit of the tool cache in MB', dest='tool_cache_size', type=int, default=1024)
+    parser.add_argument('--purge_tool_cache', help='Empty the tool cache before running', dest='purge_tool_cache', action='store_true')
+    parser.add_argument('--estimate', help='Stop simulating designs whose error is clearly above the threshold', dest='estimate', action='store_true')
+    parser.add_argument('--confidence', help='Confidence level of --estimate', dest='confidence', type=float, default=0.999)
+    parser.add_argument('--error_first', help='Skip synthesis of designs whose error is above the threshold and leave them out of the ranking', dest='error_first', action='store_true')
+    parser.add_argument('--yosys_session', help='Synthesize candidates on a persistent yosys process', dest='yosys_session', action='store_true')
+    parser.add_argument('--surrogate', help='Rank candidates by the sum of the areas of their partitions', dest='surrogate', action='store_true')
+    parser.add_argument('--hierarchical', help='Synthesize candidates from cached mapped netlists of their partitions', dest='hierarchical', action='store_true')
+    parser.add_argument('--boundary_opt', help='Optimize across partition boundaries in hierarchical synthesis', dest='boundary_opt', action='store_true')
+    parser.add_argument('--bmf_all_degrees', help='Factorize every degree of a partition in one BMF run', dest='bmf_all_degrees', action='store_true')
     parser.add_argument('--fast_deter', help='Accelerate by picking certain subcircuits to approximate', dest='deter', action='store_true')
 
     args = parser.parse_args()
@@ -49,6 +73,10 @@ def main():
     if args.cpu != -1:
         args.parallel = True
 
+    if args.max_part_inputs > 63:
+        print('[Error] Partitions may have at most 63 inputs.')
+        sys.exit(1)
+
     # Accelerate mode
     accelerate = 0
     if args.rand == True:
@@ -70,6 +98,28 @@ def main():
 
     # Create optimizer
     worker = GreedyWorker(args.input, args.liberty, config, args.testbench, args.metric, args.sta)
+    worker.bmf_backend = args.bmf_backend
+    worker.bmf_all_degrees = args.bmf_all_degrees
+    worker.bmf_sweep = args.bmf_sweep
+    worker.bmf_cpu = args.bmf_cpu
+    worker.max_part_inputs = args.max_part_inputs
+    worker.sample_size = args.sample_size
+    worker.sample_mode = args.sample_mode
+    worker.w_synth = args.w_synth
+    worker.simulator = args.simulator
+    worker.truth_format = args.truth_format
+    worker.estimate = args.estimate
+    worker.confidence = args.confidence
+    worker.error_first = args.error_first
+    worker.yosys_session = args.yosys_session
+    worker.surrogate = args.surrogate
+    worker.hierarchical = args.hierarchical
+    if args.hierarchical and args.liberty is None:
+        print('[Warning] Hierarchical synthesis needs a liberty file, synthesizing whole designs.')
+    worker.boundary_opt = args.boundary_opt
+    if args.cache is not None:
+        worker.factor_cache = FactorCache(args.cache, args.cache_size << 20)
+    toolcache.configure(args.tool_cache, args.tool_cache_size << 20, args.purge_tool_cache)
     
     # Output directory
     worker.create_output_dir(args.output)
@@ -7,6 +7,7 @@ import subprocess
 import time
 import regex as re
 from utils.banner import print_banner
+from utils.create_tb import write_stimulus
 import yaml
 
 def create_testbench(input_file, output_file, num, yosys):
@@ -78,29 +79,11 @@ def create_testbench(input_file, output_file, num, yosys):
     f.write(');\n')
         
 
-    f.write("initial\n")
-    f.write("begin\n")
     if n_inputs >= 17:
-        j=1
-        while j <= int(num):
-            f.write('# 1  pi='+str(n_inputs)+'\'b')
-            i=1
-            while i <= n_inputs:
-                n=random.randint(0, 1)
-                i+=1
-                f.write(str(n))
-            f.write(';\n')
-            f.write("#1 $display(\"%b\", po);\n")
-            j+=1
+        vectors = [random.getrandbits(n_inputs) for j in range(int(num))]
     else:
-        for j in range(2**n_inputs):
-            f.write('# 1  pi='+str(n_inputs)+'\'b')
-            f.write('{0:0>{1}}'.format(str(bin(j))[2:], n_inputs))
-            f.write(';\n')
-            f.write("#1 $display(\"%b\", po);\n")
-                       
-    f.write("end\n")
-    f.write("endmodule\n")
+        vectors = range(2**n_inputs)
+    write_stimulus(f, n_inputs, vectors, os.path.splitext(output_file)[0] + '.vec')
 
     f.close()
 
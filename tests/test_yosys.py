@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+import unittest
+from utils.yosys import YosysSession
+
+VERILOG = '''module m(a, b, y);
+input a, b;
+output y;
+assign y = a & ~b;
+endmodule
+'''
+
+
+@unittest.skipUnless(shutil.which('yosys'), 'yosys is not on PATH')
+class YosysSessionTest(unittest.TestCase):
+    def test_two_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'm.v')
+            with open(path, 'w') as f:
+                f.write(VERILOG)
+
+            session = YosysSession('yosys', timeout=60)
+            try:
+                first = session.synth([path], ['synth -flatten', 'stat'])
+                second = session.synth([path], ['synth -flatten', 'stat'])
+            finally:
+                session.close()
+
+        for lines in (first, second):
+            self.assertTrue(any('Number of cells' in line for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
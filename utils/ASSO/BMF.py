@@ -1,66 +1,196 @@
 import numpy as np
 import os
 import shutil
+import multiprocessing as mp
 from .utils import *
+from . import bitpack
+
+BACKENDS = ['dense', 'packed']
+
+SWEEPS = ['full', 'parallel', 'adaptive']
+
+THRESHOLD_LIST = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# Adaptive sweep: coarse grid first, then the neighbours of the best thresholds
+COARSE_THRESHOLD_LIST = [0.1, 0.3, 0.5, 0.7, 0.9]
+
+
+def factorize(truthtable, k, binary = False, backend = 'dense', sweep = 'full', processes = None):
+    '''
+    Factorize a truth table (file path or 0/1 matrix) to degree k.
+    Returns W, H and their boolean product WH as uint8 arrays.
+    '''
+    input_truth = get_matrix(truthtable) if isinstance(truthtable, str) else truthtable
+
+    best = threshold_sweep(input_truth, k, binary, backend, sweep, processes)
+    score, threshold, S, B = best[k]
+
+    return refit(input_truth, S[:, :k])
+
+
+def factorize_all_degrees(truthtable, max_k, binary = False, backend = 'dense', sweep = 'full', processes = None):
+    '''
+    Factorize a truth table to every degree 1..max_k with a single greedy run
+    per threshold. Returns {k: (W, H, WH)} and the best threshold of each degree.
+    '''
+    input_truth = get_matrix(truthtable) if isinstance(truthtable, str) else truthtable
+
+    best = threshold_sweep(input_truth, max_k, binary, backend, sweep, processes)
+
+    factors = {k: refit(input_truth, best[k][2][:, :k]) for k in range(1, max_k+1)}
+    return factors, {k: best[k][1] for k in best}
+
+
+def BMF(truthtable, k, binary = False, backend = 'dense', sweep = 'full', processes = None, save = True):
+    W, H, WH = factorize(truthtable, k, binary, backend, sweep, processes)
+    if save:
+        save_factorization(truthtable, k, W, H, WH)
+    return W, H, WH
+
+
+def BMF_all_degrees(truthtable, max_k, binary = False, backend = 'dense', sweep = 'full', processes = None, save = True):
+    factors, thresholds = factorize_all_degrees(truthtable, max_k, binary, backend, sweep, processes)
+    if save:
+        for k in factors:
+            save_factorization(truthtable, k, *factors[k])
+    return factors
+
+
+def asso_trial(input_truth, max_k, association, binary = False, backend = 'dense', bound = None):
+    '''
+    Run the greedy ASSO search for one association matrix up to degree max_k.
+
+    Returns the score of every degree together with the dense solver S and
+    basis B of the last step; the first k columns of S (rows of B) are the
+    factorization of degree k. If bound is given (best score of each degree so
+    far), the run stops as soon as the false positives of the product, which
+    later bases can never remove, reach the bound of every remaining degree.
+    Degrees that were not reached score inf.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown BMF backend {}'.format(backend))
 
-def BMF(truthtable, k, binary = False):
-    # Read in input truthtable
-    input_truth = get_matrix(truthtable)
     row, col = input_truth.shape
-    
-    # Output path
-    B_path = truthtable + '_h_' + str(k)
-    S_path = truthtable + '_w_' + str(k)
-    mult_path = truthtable + '_wh_' + str(k)
-
-    # Best pair
-    best_B = -1
-    best_S = -1
-    best_result = -1
-    best_score = float('inf')
-
-    threshold_list = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-
-    for threshold in threshold_list:
-        association = calculate_association(input_truth, threshold)
-        S, B, result = solve_basis(input_truth, k, association, 1, -1, binary)
-        if binary:
-            score = weighted_HD(input_truth, result)
-        else:
-            score = HD(input_truth, result)
-
-        if score < best_score:
-            best_B = B
-            best_S = S
-            best_result = result
-            best_score = score
-    
-    # Enumerate possible columns
-    column_list = []
-    multi_list = []
-    for i in range(2**k):
-        binary_str = '{0:0>{1}}'.format(bin(i)[2:], k)
-        column = np.array(list(binary_str)).astype(np.uint8)
-        column_list.append(column)
-        prod = np.matmul(best_S, column)
-        prod = prod % 2
-        multi_list.append(prod)
-    
-    # Brute force best column in B
-    for i in range(col):
-        ground_truth = input_truth[:, i]
-        best_similar = 0
-        best_idx = -1
-        for j in range(2**k):
-            similar = sum(multi_list[j] == ground_truth)
-            if similar > best_similar:
-                best_idx = j
-                best_similar = similar
-        best_B[:, i] = column_list[best_idx]
-
-    
-    write_matrix(best_B, B_path)
-    write_matrix(best_S, S_path)
+
+    if backend == 'packed':
+        truth = bitpack.pack_columns(input_truth)
+        steps = bitpack.solve_basis_steps(truth, row, max_k, association, 1, -1, binary)
+        distance = bitpack.weighted_HD if binary else bitpack.HD
+    else:
+        truth = input_truth
+        steps = solve_basis_steps(truth, max_k, association, 1, -1, binary)
+        distance = weighted_HD if binary else HD
+
+    scores = [float('inf')] * max_k
+    for k, (S, B, result) in enumerate(steps, 1):
+        scores[k-1] = distance(truth, result)
+
+        if bound is not None and k < max_k:
+            false_positive = distance(truth, truth | result)
+            if false_positive >= max(bound[k:]):
+                break
+
+    if backend == 'packed':
+        S = bitpack.unpack_columns(S, row)
+
+    return scores, np.array(S), np.array(B)
+
+
+def threshold_sweep(input_truth, max_k, binary = False, backend = 'dense', sweep = 'full', processes = None):
+    '''
+    Try the ASSO thresholds and keep the best factorization of every degree.
+    Returns {k: (score, threshold, S, B)}.
+
+    full:     every threshold in turn.
+    parallel: every threshold on a process pool, same result as full. Falls
+              back to full inside daemonic pool workers, which cannot fork.
+    adaptive: coarse grid, then refine around the best threshold of each
+              degree, pruning trials that cannot beat the current best.
+    '''
+    if sweep not in SWEEPS:
+        raise ValueError('Unknown threshold sweep {}'.format(sweep))
+
+    association = dict(zip(THRESHOLD_LIST, calculate_association_all(input_truth, THRESHOLD_LIST)))
+    best = {}
+
+    def update(threshold, scores, S, B):
+        # Ties go to the lower threshold, as in the sequential sweep
+        for k in range(1, max_k+1):
+            score = scores[k-1]
+            if k not in best or (score, threshold) < best[k][:2]:
+                best[k] = (score, threshold, S, B)
+
+    if sweep == 'parallel' and not mp.current_process().daemon:
+        if processes is None:
+            processes = min(mp.cpu_count(), len(THRESHOLD_LIST))
+        pool = mp.Pool(processes)
+        results = [pool.apply_async(asso_trial, args=(input_truth, max_k, association[t], binary, backend)) for t in THRESHOLD_LIST]
+        pool.close()
+        pool.join()
+        for threshold, result in zip(THRESHOLD_LIST, results):
+            update(threshold, *result.get())
+
+    elif sweep == 'adaptive':
+        tried = []
+        candidates = list(COARSE_THRESHOLD_LIST)
+        while len(candidates) > 0:
+            for threshold in candidates:
+                bound = [best[k][0] for k in range(1, max_k+1)] if len(best) > 0 else None
+                update(threshold, *asso_trial(input_truth, max_k, association[threshold], binary, backend, bound))
+                tried.append(threshold)
+
+                # Nothing beats an exact factorization of every degree
+                if all(best[k][0] == 0 for k in best):
+                    return best
+
+            # Refine around the best threshold of each degree
+            candidates = set()
+            for k in best:
+                idx = THRESHOLD_LIST.index(best[k][1])
+                for n in (idx - 1, idx + 1):
+                    if 0 <= n < len(THRESHOLD_LIST) and THRESHOLD_LIST[n] not in tried:
+                        candidates.add(THRESHOLD_LIST[n])
+            candidates = sorted(candidates)
+
+    else:
+        for threshold in THRESHOLD_LIST:
+            update(threshold, *asso_trial(input_truth, max_k, association[threshold], binary, backend))
+
+    return best
+
+
+def refit(input_truth, best_S):
+    row, col = input_truth.shape
+
+    # Exhaustive search of the best column of B for each output
+    packed_S = bitpack.pack_columns(best_S)
+    packed_truth = bitpack.pack_columns(input_truth)
+    best_B = bitpack.best_columns(packed_S, packed_truth, row)
+
     new_best_result = np.matmul(best_S, best_B)
     new_best_result = new_best_result % 2
-    write_matrix(new_best_result, mult_path)
\ No newline at end of file
+    return best_S, best_B, new_best_result
+
+
+def factor_paths(truthtable, k):
+    return truthtable + '_w_' + str(k) + '.npy', truthtable + '_h_' + str(k) + '.npy', truthtable + '_wh_' + str(k) + '.npy'
+
+
+def save_factorization(truthtable, k, W, H, WH):
+    W_path, H_path, WH_path = factor_paths(truthtable, k)
+
+    # W is written last, so an existing W file means the whole set is there
+    for mat, path in ((H, H_path), (WH, WH_path), (W, W_path)):
+        tmp_path = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+        np.save(tmp_path, mat)
+        os.replace(tmp_path, path)
+
+
+def load_factorization(truthtable, k):
+    '''
+    Returns the saved W, H, WH of degree k, or None if there are none.
+    '''
+    W_path, H_path, WH_path = factor_paths(truthtable, k)
+    if not os.path.exists(W_path):
+        return None
+    return np.load(W_path), np.load(H_path), np.load(WH_path)
@@ -0,0 +1,223 @@
+import numpy as np
+
+# Truth-table columns are stored as packed 64-bit words: row r of a column
+# lives in word r // 64, bit r % 64. Padding bits past the last row are 0.
+
+WORD = 64
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    '''
+    Number of set bits of each 64-bit word
+    '''
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).astype(np.int64)
+    counts = _POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,))
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+def num_words(row):
+    return (row + WORD - 1) // WORD
+
+
+def pack_columns(matrix):
+    '''
+    Pack a (row, col) 0/1 matrix into a (col, words) uint64 array
+    '''
+    row, col = matrix.shape
+    padded = np.zeros((num_words(row) * WORD, col), dtype=np.uint8)
+    padded[:row, :] = matrix
+    packed = np.ascontiguousarray(np.packbits(padded.T, axis=1, bitorder='little'))
+    return packed.view('<u8').astype(np.uint64, copy=False).reshape(col, -1)
+
+
+def unpack_columns(packed, row):
+    '''
+    Inverse of pack_columns, returns a (row, col) uint8 matrix
+    '''
+    packed = np.ascontiguousarray(packed, dtype='<u8')
+    bits = np.unpackbits(packed.view(np.uint8), axis=1, bitorder='little')
+    return bits[:, :row].T.astype(np.uint8)
+
+
+def valid_mask(row):
+    '''
+    Word mask with the bits of existing rows set
+    '''
+    mask = np.full(num_words(row), np.uint64(0xFFFFFFFFFFFFFFFF), dtype=np.uint64)
+    if row % WORD != 0:
+        mask[-1] = np.uint64((1 << (row % WORD)) - 1)
+    return mask
+
+
+def HD(org, app):
+    assert org.shape == app.shape
+    return int(popcount(org ^ app).sum())
+
+
+def weighted_HD(org, app):
+    assert org.shape == app.shape
+    col = org.shape[0]
+    per_col = popcount(org ^ app).sum(axis=1)
+    return sum(int(c) << (col - 1 - j) for j, c in enumerate(per_col))
+
+
+def _increment(planes, x):
+    # Add one bit per row to a bit-sliced counter (planes[0] is the LSB)
+    carry = x
+    for idx in range(len(planes)):
+        plane = planes[idx]
+        planes[idx] = plane ^ carry
+        carry = plane & carry
+        if not carry.any():
+            return
+    planes.append(carry)
+
+
+def _greater(a_planes, b_planes, words):
+    # Rows where bit-sliced counter a is strictly greater than b
+    zero = np.zeros(words, dtype=np.uint64)
+    gt = zero.copy()
+    eq = ~zero
+    for i in range(max(len(a_planes), len(b_planes)) - 1, -1, -1):
+        a = a_planes[i] if i < len(a_planes) else zero
+        b = b_planes[i] if i < len(b_planes) else zero
+        gt |= eq & a & ~b
+        eq &= ~(a ^ b)
+    return gt
+
+
+def solve_basis(packed, row, k, asso, bonus, penalty, binary=False):
+    for S, B, covered in solve_basis_steps(packed, row, k, asso, bonus, penalty, binary):
+        pass
+    return S, B, covered
+
+
+def solve_basis_steps(packed, row, k, asso, bonus, penalty, binary=False):
+    '''
+    Packed counterpart of utils.solve_basis_steps.
+
+    packed is the (col, words) truth table from pack_columns. After each added
+    basis, yields the solver S as (i, words) packed columns, the basis B as
+    (i, col) uint8 and the packed boolean product S o B. The arrays are
+    updated in place by later steps; copy them to keep a prefix. Scores are exact integers, so the result
+    matches the dense kernel whenever its float scores are exact
+    (col + log2(row) <= 53 in binary mode).
+    '''
+    if penalty != -bonus or bonus <= 0:
+        raise ValueError('Packed backend requires penalty == -bonus > 0')
+
+    col, words = packed.shape
+    mask = valid_mask(row)
+    neg_packed = ~packed & mask
+
+    covered = np.zeros((col, words), dtype=np.uint64)
+    S = np.zeros((k, words), dtype=np.uint64)
+    B = np.zeros((k, col), dtype=np.uint8)
+
+    for i in range(k):
+
+        # Uncovered entries that would gain (P) or lose (N) when covered
+        P = packed & ~covered
+        N = neg_packed & ~covered
+
+        best_basis = np.zeros(col, dtype=np.uint8)
+        best_solver = np.zeros(words, dtype=np.uint64)
+        best_score = 0
+
+        for b in range(col):
+            basis = asso[b, :]
+            cols = np.nonzero(basis)[0]
+
+            # Rows with positive score
+            if binary:
+                # Weights are distinct powers of two, so the most significant
+                # uncovered column decides the sign of each row
+                solver = np.zeros(words, dtype=np.uint64)
+                decided = np.zeros(words, dtype=np.uint64)
+                for j in cols:
+                    solver |= P[j] & ~decided
+                    decided |= P[j] | N[j]
+            else:
+                pos_planes = []
+                neg_planes = []
+                for j in cols:
+                    _increment(pos_planes, P[j])
+                    _increment(neg_planes, N[j])
+                solver = _greater(pos_planes, neg_planes, words)
+
+            # Accumulated score over selected rows
+            gain = popcount(P[cols] & solver).sum(axis=1) - popcount(N[cols] & solver).sum(axis=1)
+            if binary:
+                score = sum(int(g) << (col - 1 - j) for j, g in zip(cols, gain))
+            else:
+                score = int(gain.sum())
+            score *= bonus
+
+            if score > best_score:
+                best_basis = basis
+                best_solver = solver
+                best_score = score
+
+        S[i] = best_solver
+        B[i] = best_basis
+
+        # Update covered matrix
+        for j in np.nonzero(best_basis)[0]:
+            covered[j] |= best_solver
+
+        yield S[:i+1], B[:i+1], covered
+
+
+def best_columns(S, packed, row, max_words=1<<18):
+    '''
+    Exhaustive refit of H. For every column of the packed truth table, find
+    the k-bit code whose XOR product with the packed solver S (k, words) agrees
+    with the column on the most rows. Ties go to the smallest code, and a
+    column no code agrees with at all gets the all-ones code, as in the
+    original per-code loop. Returns H as a (k, col) uint8 matrix.
+
+    Code bit (k-1-t) selects column t of S. Products of the low code bits are
+    tabulated once, and the high bits are walked in Gray-code order so that
+    each chunk costs a single XOR with one solver column.
+    '''
+    k = S.shape[0]
+    col, words = packed.shape
+
+    # Low bits covered by the table, bounded by max_words per chunk
+    low = 0
+    while low < k and (2 << low) * words <= max_words:
+        low += 1
+
+    table = np.zeros((1 << low, words), dtype=np.uint64)
+    for b in range(low):
+        table[1<<b : 2<<b] = table[:1<<b] ^ S[k-1-b]
+
+    best_similar = np.full(col, -1, dtype=np.int64)
+    best_code = np.zeros(col, dtype=np.int64)
+
+    offset = np.zeros(words, dtype=np.uint64)
+    for h in range(1 << (k - low)):
+        if h > 0:
+            # Gray code flips the lowest set bit of h
+            flip = (h & -h).bit_length() - 1
+            offset = offset ^ S[k-1-(low+flip)]
+        gray = h ^ (h >> 1)
+        prods = table ^ offset
+
+        for c in range(col):
+            similar = row - popcount(prods ^ packed[c]).sum(axis=1)
+            idx = int(np.argmax(similar))
+            code = (gray << low) | idx
+            if similar[idx] > best_similar[c] or (similar[idx] == best_similar[c] and code < best_code[c]):
+                best_similar[c] = similar[idx]
+                best_code[c] = code
+
+    # No agreeing code at all falls back to the last code
+    best_code[best_similar <= 0] = (1 << k) - 1
+
+    shifts = np.arange(k-1, -1, -1)
+    return ((best_code[None, :] >> shifts[:, None]) & 1).astype(np.uint8)
@@ -1,19 +1,10 @@
 import numpy as np
+from ..truthtable import load_truth
 
 
 def get_matrix(file_path):
-    with open(file_path) as f:
-        lines = f.readlines()
-    mat = [list(i.strip().replace(' ', '')) for i in lines]
-    return np.array(mat, dtype=np.uint8)
-
-
-def write_matrix(mat, file_path):
-    with open(file_path, 'w') as f:
-        for row in mat:
-            for ele in row:
-                f.write('{} '.format(ele))
-            f.write('\n')
+    # Text or binary truth table
+    return load_truth(file_path)
 
 
 def HD(org, app):
@@ -32,22 +23,33 @@ def weighted_HD(org, app):
 
 # Compute association matrix
 def calculate_association(matrix, threshold=0.5):
-    row, col = matrix.shape
-    ASSO = np.zeros((col, col))
-    for i in range(col):
-        idx = (matrix[:, i] == 1)
-        for j in range(col):
-            ASSO[i, j] = sum(matrix[:, j][idx])
-        if ASSO[i, i] != 0:
-            ASSO[i, :] = ASSO[i, :] / ASSO[i, i]
-    
-    ASSO[ASSO >= threshold] = 1
-    ASSO[ASSO < threshold] = 0
+    return calculate_association_all(matrix, [threshold])[0]
+
+
+# Compute association matrices for a list of thresholds from a single
+# co-occurrence product
+def calculate_association_all(matrix, threshold_list):
+    # ASSO[i, j] counts rows where both column i and column j are 1
+    mat = matrix.astype(np.int64)
+    ASSO = np.matmul(mat.T, mat).astype(float)
+
+    # Normalize each row by its diagonal (support of column i)
+    diag = np.diag(ASSO).copy()
+    nonzero = diag != 0
+    ASSO[nonzero, :] = ASSO[nonzero, :] / diag[nonzero, None]
 
-    return ASSO.astype(np.uint8)
+    return [(ASSO >= threshold).astype(np.uint8) for threshold in threshold_list]
 
 
 def solve_basis(matrix, k, asso, bonus, penalty, binary=False):
+    for S, B, covered in solve_basis_steps(matrix, k, asso, bonus, penalty, binary):
+        pass
+    return S, B, covered
+
+
+# Greedy basis selection, yielding (S, B, covered) after each added basis.
+# The first i bases do not depend on k, so one run serves every degree <= k.
+def solve_basis_steps(matrix, k, asso, bonus, penalty, binary=False):
 
     row, col = matrix.shape
 
@@ -101,8 +103,8 @@ def solve_basis(matrix, k, asso, bonus, penalty, binary=False):
         # Update covered matrix
         covered = np.matmul(S, B)
         covered[covered > 1] = 1
-    
-    return S, B, covered
+
+        yield S, B, covered
 
 
 
@@ -0,0 +1,156 @@
+import os
+import hashlib
+import regex as re
+import numpy as np
+
+
+def evict(directory, max_size):
+    '''
+    Remove least recently used files of a cache directory until it fits
+    max_size bytes
+    '''
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class FactorCache():
+    '''
+    On-disk cache of BMF factorizations and the Verilog generated from them,
+    shared by runs and processes. Entries are addressed by a hash of the
+    partition truth table, the degree and the settings that affect the result.
+    Hits refresh the modification time, and the least recently used entries
+    are evicted once the cache grows beyond max_size bytes.
+    '''
+    VERSION = 'blasys-factor-cache-1'
+
+    def __init__(self, directory, max_size=1<<30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def factor_key(self, truth, k, settings):
+        h = hashlib.sha256(self.VERSION.encode())
+        h.update(repr((truth.shape, k, settings)).encode())
+        h.update(np.ascontiguousarray(truth, dtype=np.uint8).tobytes())
+        return h.hexdigest()
+
+
+    def verilog_key(self, factor_key, settings, samples=None):
+        h = hashlib.sha256(factor_key.encode())
+        h.update(repr(settings).encode())
+        if samples is not None:
+            h.update(np.array(samples, dtype=np.uint64).tobytes())
+        return h.hexdigest()
+
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+
+    def _read(self, path, loader):
+        try:
+            result = loader(path)
+            os.utime(path)
+            return result
+        except (OSError, ValueError):
+            return None
+
+
+    def _write(self, path, writer):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            writer(f)
+        os.replace(tmp_path, path)
+
+
+    def get_factors(self, key):
+        def load(path):
+            with np.load(path) as data:
+                return data['W'], data['H'], data['WH']
+        return self._read(self._path(key, '.npz'), load)
+
+
+    def put_factors(self, key, W, H, WH):
+        self._write(self._path(key, '.npz'), lambda f: np.savez(f, W=W, H=H, WH=WH))
+
+
+    def get_verilog(self, key, modulename, k):
+        '''
+        Cached Verilog with its modules renamed after modulename
+        '''
+        def load(path):
+            with open(path) as f:
+                old_name = f.readline().strip()
+                text = f.read()
+            pattern = r'\b' + re.escape(old_name) + r'(_w' + str(k) + r'|_h' + str(k) + r')?\b'
+            return re.sub(pattern, lambda m: modulename + (m.group(1) or ''), text)
+        return self._read(self._path(key, '.v'), load)
+
+
+    def put_verilog(self, key, modulename, text):
+        # First line records the module name used in the text
+        self._write(self._path(key, '.v'), lambda f: f.write((modulename + '\n' + text).encode()))
+
+
+    def evict(self):
+        evict(self.directory, self.max_size)
+
+
+class FormulaMemo():
+    '''
+    Verilog expressions of W columns keyed by the synthesis method and the
+    truth string of the column. Kept in memory and in a directory shared by
+    the pool workers of a run.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.formulas = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def _key(self, method, truth):
+        return hashlib.sha256((method + ':' + truth).encode()).hexdigest()
+
+
+    def get(self, method, truth):
+        key = self._key(method, truth)
+        if key not in self.formulas:
+            try:
+                with open(os.path.join(self.directory, key + '.v')) as f:
+                    self.formulas[key] = f.read()
+            except OSError:
+                return None
+        return self.formulas[key]
+
+
+    def put(self, method, truth, formula):
+        key = self._key(method, truth)
+        self.formulas[key] = formula
+        path = os.path.join(self.directory, key + '.v')
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(formula)
+        os.replace(tmp_path, path)
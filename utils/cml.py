@@ -50,6 +50,8 @@ class Blasys(Cmd):
         self.cpu = mp.cpu_count()
         self.sta = False
         self.metric = 'HD'
+        self.bmf_sweep = 'full'
+        self.bmf_cpu = None
 
     
     def do_exit(self, args):
@@ -119,6 +121,8 @@ class Blasys(Cmd):
 
         # Initial BLASYS
         self.optimizer = GreedyWorker(input_file, self.liberty, config, None, self.metric, self.sta)
+        self.optimizer.bmf_sweep = self.bmf_sweep
+        self.optimizer.bmf_cpu = self.bmf_cpu
         self.input_file = input_file
         ret = module_info(input_file, config['yosys'])
         self.n_cell = number_of_cell(input_file, config['yosys'])
@@ -247,6 +251,35 @@ class Blasys(Cmd):
 
 
 
+    def do_bmf_sweep(self, args):
+        args_list = args.split()
+
+        if len(args_list) == 0 or args_list[0] not in ['full', 'parallel', 'adaptive']:
+            print('[Error] Invalid arguments.')
+            self.help_bmf_sweep()
+            return
+
+        cpu = None
+        if len(args_list) == 3 and args_list[1] == '-cpu' and args_list[2].isdigit():
+            cpu = int(args_list[2])
+        elif len(args_list) != 1:
+            print('[Error] Invalid arguments.')
+            self.help_bmf_sweep()
+            return
+
+        self.bmf_sweep = args_list[0]
+        self.bmf_cpu = cpu
+        if self.optimizer is not None:
+            self.optimizer.bmf_sweep = self.bmf_sweep
+            self.optimizer.bmf_cpu = self.bmf_cpu
+
+        print('Set BMF threshold sweep to {}.\n'.format(self.bmf_sweep))
+
+    def help_bmf_sweep(self):
+        print('[Usage] bmf_sweep full/parallel/adaptive [-cpu NUMBER_OF_CORES]\n')
+
+
+
     def do_metric(self, args):
 
         # if self.optimizer is None:
@@ -1,6 +1,7 @@
 import regex as re
 import sys
 import random
+import os
 
 def create_testbench(path, num, f):
     modulename = None
@@ -47,28 +48,40 @@ def create_testbench(path, num, f):
         f.write(', po[{}]'.format(i))
     f.write(');\n')
 
-    f.write("initial\n")
-    f.write("begin\n")
     if n_inputs >= 17:
-            j=1
-            while j <= int(num):
-	            f.write('# 1  pi='+str(n_inputs)+'\'b')
-	            i=1
-	            while i <= n_inputs:
-		            n=random.randint(0, 1)
-		            i+=1
-		            f.write(str(n))
-	            f.write(';\n')
-	            f.write("#1 $display(\"%b\", po);\n")
-	            j+=1
+            vectors = [random.getrandbits(n_inputs) for j in range(int(num))]
     else:
-            for j in range(2**n_inputs):
- 	            f.write('# 1  pi='+str(n_inputs)+'\'b')
- 	            f.write('{0:0>{1}}'.format(str(bin(j))[2:], n_inputs))
- 	            f.write(';\n')
- 	            f.write("#1 $display(\"%b\", po);\n")
-                       
+            vectors = range(2**n_inputs)
+    write_stimulus(f, n_inputs, vectors, os.path.splitext(f.name)[0] + '.vec')
+
+
+def write_vectors(path, n_inputs, vectors):
+    '''
+    Test vectors as read by $readmemb, one line per vector, MSB first
+    '''
+    with open(path, 'w') as f:
+        for j in vectors:
+            f.write('{0:0>{1}}\n'.format(bin(j)[2:], n_inputs))
+
+
+def write_stimulus(f, n_inputs, vectors, vector_file):
+    '''
+    Body of a testbench that loads the vectors from vector_file with
+    $readmemb, applies them to pi in turn and prints po after each one. The
+    testbench stays the same size whatever the number of vectors.
+    '''
+    write_vectors(vector_file, n_inputs, vectors)
+    num = len(vectors)
+
+    f.write('reg ['+str(n_inputs-1)+':0] vectors [0:'+str(num-1)+'];\n')
+    f.write('integer i;\n')
+    f.write("initial\n")
+    f.write("begin\n")
+    f.write('$readmemb("'+os.path.abspath(vector_file)+'", vectors);\n')
+    f.write('for (i = 0; i < '+str(num)+'; i = i + 1)\n')
+    f.write("begin\n")
+    f.write('# 1  pi=vectors[i];\n')
+    f.write('#1 $fwrite(32\'h8000_0001, "%b\\n", po);\n')
+    f.write("end\n")
     f.write("end\n")
     f.write("endmodule\n")
-
-	    
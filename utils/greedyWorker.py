@@ -10,10 +10,13 @@ import multiprocessing as mp
 import shutil
 import time
 import ctypes
-from .utils import gen_truth, evaluate_design, synth_design, inpout, number_of_cell, write_aiger, get_delay, get_power, approximate, create_wrapper, module_info, NoValidDesign, create_wrapper_single
+from .utils import gen_truth, evaluate_design, evaluate_surrogate, synthesize_design, variant_area, simulate_truth, synth_design, inpout, number_of_cell, write_aiger, get_delay, get_power, approximate, create_wrapper, module_info, NoValidDesign, create_wrapper_single
 from .optimizer import optimization, least_error_opt
 from .create_tb import create_testbench
+from .cache import FormulaMemo
+from .truthtable import SharedTruthTable, attach_truth
 from . import metric
+from . import toolcache
 
 
 class GreedyWorker():
@@ -49,7 +52,61 @@ class GreedyWorker():
 
         self.iter_rank = [0]
 
+        # BMF settings
+        self.bmf_backend = 'dense'
+        self.bmf_all_degrees = False
+        self.bmf_sweep = 'full'
+        self.bmf_cpu = None
+
+        # Partitions with more than 16 inputs are factorized on sampled rows
+        self.max_part_inputs = 16
+        self.sample_size = 4096
+        self.sample_mode = 'random'
+
+        # Synthesis of W columns, 'abc' or 'isop'
+        self.w_synth = 'abc'
+        self.formula_memo = None
+
+        # Truth tables on disk, 'text' or 'binary'
+        self.truth_format = 'text'
+
+        # Simulation of candidate designs, 'numpy', 'lut' or 'iverilog'
+        self.simulator = 'iverilog'
+
+        # Factorization cache shared across runs, disabled if None
+        self.factor_cache = None
+
+        # Monte Carlo error estimation on random testbenches. Designs whose
+        # error is above error_bound with the given confidence stop early.
+        self.estimate = False
+        self.confidence = 0.999
+        self.error_bound = None
+
+        # Measure the error of candidates before synthesizing them, and skip
+        # synthesis of those above error_bound
+        self.error_first = False
+
+        # Synthesize candidates on a yosys process kept by each pool process
+        self.yosys_session = False
+
+        # Rank candidates by an additive area surrogate, the areas of their
+        # partitions synthesized alone plus the top-level glue. Only the
+        # designs kept for the next iteration, or written as results, are
+        # synthesized as a whole.
+        self.surrogate = False
+        self.glue_area = None
+        self.stream_of = {}
+
+        # Synthesize candidates from the cached mapped netlists of their
+        # partitions, mapping only the top-level glue again. Needs a liberty.
+        self.hierarchical = False
+        self.boundary_opt = False
+
+        # Ground truth of the design in shared memory, loaded by evaluate_initial
+        self.ground_truth = None
+
         # Get metric function
+        self.metric_name = err_metric
         try:
             self.metric = getattr(metric, err_metric)
         except AttributeError:
@@ -88,8 +145,14 @@ class GreedyWorker():
         os.mkdir(os.path.join(self.output, 'truthtable'))
         os.mkdir(os.path.join(self.output, 'result'))
         os.mkdir(os.path.join(self.output, 'log'))
+        with open(os.path.join(self.output, 'log', 'metrics.csv'), 'w') as f:
+            f.write(','.join(['Design'] + metric.DISTANCE) + '\n')
+        with open(os.path.join(self.output, 'log', 'rejected.csv'), 'w') as f:
+            f.write('Design,Metric\n')
         bmf_part = 'bmf_partition'
         os.mkdir(os.path.join(self.output, bmf_part))
+        # Formulas of W columns shared by every partition of the run
+        self.formula_memo = FormulaMemo(os.path.join(self.output, 'formula'))
         # Write script
         dir_path = os.path.dirname(os.path.realpath(__file__))
         self.script = os.path.join(dir_path, '..', 'config', 'abc.script')
@@ -192,11 +255,12 @@ class GreedyWorker():
 
     def evaluate_initial(self):
         print('Simulating truth table on input design...')
-        subprocess.call([self.path['iverilog'], '-o', self.modulename+'.iv', self.input, self.testbench ])
+        toolcache.call([self.path['iverilog'], '-o', self.modulename+'.iv', self.input, self.testbench ], [self.input, self.testbench], [self.modulename+'.iv'])
         output_truth = os.path.join(self.output, self.modulename+'.truth')
-        with open(output_truth, 'w') as f:
-            subprocess.call([self.path['vvp'], self.modulename+'.iv'], stdout=f)
+        simulate_truth(self.path['vvp'], self.modulename+'.iv', output_truth, self.truth_format)
         os.remove(self.modulename + '.iv')
+        self.release_truth()
+        self.ground_truth = SharedTruthTable(output_truth)
 
         print('Synthesizing input design with original partitions...')
         output_synth = os.path.join(self.output, self.modulename)
@@ -251,7 +315,7 @@ class GreedyWorker():
                 continue
 
             inp, out = inpout(mod_path)
-            if inp > 16:
+            if inp > self.max_part_inputs:
                 lsoracle_command = 'read_verilog ' + mod_path + '; ' \
                         'partitioning 3 -c ' + self.path['part_config'] + '; ' \
                         'get_all_partitions ' + part_dir
@@ -263,7 +327,7 @@ class GreedyWorker():
                     subprocess.call(['cat', mod_path], stdout=top)
 
                 os.remove(mod_path)
-            elif 0 < inp <= 16:
+            elif 0 < inp <= self.max_part_inputs:
                 self.modulenames.append(mod)
 
         print('Number of partitions', len(self.modulenames))
@@ -301,7 +365,7 @@ class GreedyWorker():
 
             # Create testbench for partition
             print('Create testbench for partition '+str(i))
-            n, m = gen_truth(file_path, modulename)
+            n, m = gen_truth(file_path, modulename, self.sample_size, self.sample_mode, self.max_part_inputs)
             self.input_list.append( n )
             self.output_list.append( m )
 
@@ -309,10 +373,10 @@ class GreedyWorker():
             print('Generate truth table for partition '+str(i))
             part_output_dir = os.path.join(self.output, 'bmf_partition', modulename)
             os.mkdir(part_output_dir)
-            subprocess.call([self.path['iverilog'], '-o', file_path+'.iv', file_path+'.v', file_path+'_tb.v'])
-            with open( os.path.join(part_output_dir, modulename + '.truth'), 'w') as f:
-                subprocess.call([self.path['vvp'], file_path+'.iv'], stdout=f)
-                os.remove(file_path+'.iv')
+            toolcache.call([self.path['iverilog'], '-o', file_path+'.iv', file_path+'.v', file_path+'_tb.v'], [file_path+'.v', file_path+'_tb.v'], [file_path+'.iv'])
+            part_truth = os.path.join(part_output_dir, modulename + '.truth')
+            simulate_truth(self.path['vvp'], file_path+'.iv', part_truth, self.truth_format)
+            os.remove(file_path+'.iv')
 
         self.curr_stream = self.output_list.copy()
         self.curr_streams = [self.output_list.copy()]
@@ -321,9 +385,30 @@ class GreedyWorker():
 
     def greedy_opt(self, parallel, cpu_count, step_size = 1, threshold=[1000000.], track=3, accel=0):
         threshold.sort()
-        while True:
-            if self.next_iter(parallel, cpu_count, step_size, threshold, track=track, accel=accel) == -1:
-                break
+        try:
+            while True:
+                if self.next_iter(parallel, cpu_count, step_size, threshold, track=track, accel=accel) == -1:
+                    break
+        finally:
+            self.release_truth()
+
+
+    def pool(self, cpu_count):
+        '''
+        Process pool whose workers attach the shared ground truth once
+        '''
+        if self.ground_truth is None:
+            return mp.Pool(cpu_count)
+        return mp.Pool(cpu_count, initializer=attach_truth, initargs=(self.ground_truth.state(),))
+
+
+    def release_truth(self):
+        '''
+        Free the shared memory of the ground truth
+        '''
+        if self.ground_truth is not None:
+            self.ground_truth.release()
+            self.ground_truth = None
 
 
     def next_iter(self, parallel, cpu_count, step_size, threshold=[1000000.], least_error=False, track=3, accel=0):
@@ -373,12 +458,7 @@ class GreedyWorker():
             a[e > threshold[0]] = np.inf
             idx = np.argmin(a)
 
-            if idx == 0:
-                source_file = os.path.join(self.output, self.modulename + '.v')
-                source_file_syn = os.path.join(self.output, self.modulename + '_syn.v')
-            else:
-                source_file = os.path.join(self.output, 'tmp', '{}.v'.format(self.design_list[idx - 1]))
-                source_file_syn = os.path.join(self.output, 'tmp', '{}_syn.v'.format(self.design_list[idx - 1]))
+            source_file, source_file_syn = self.netlists(idx)
 
             target_file = os.path.join(self.output, 'result', '{}_{}.v'.format(self.modulename, 'REST'))
             target_file_syn = os.path.join(self.output, 'result', '{}_{}_syn.v'.format(self.modulename, 'REST'))
@@ -392,6 +472,21 @@ class GreedyWorker():
             return -1
 
 
+        if self.surrogate:
+            # Synthesize the designs kept for the next iteration
+            kept = list(rank[:track])
+            if parallel:
+                pool = self.pool(cpu_count)
+                results = [pool.apply_async(synthesize_design, args=(streams[i], self, name_list[i])) for i in kept]
+                pool.close()
+                pool.join()
+                results = [result.get() for result in results]
+            else:
+                results = [synthesize_design(streams[i], self, name_list[i]) for i in kept]
+            for i, res in zip(kept, results):
+                if res is not None:
+                    area[i], delay[i], power[i] = res
+
         after = time.time()
 
 
@@ -423,6 +518,7 @@ class GreedyWorker():
         self.error_list += err
         self.area_list += area
         self.design_list += name_list
+        self.stream_of.update(zip(name_list, streams))
         self.power_list += power
         self.delay_list += delay
 
@@ -436,12 +532,7 @@ class GreedyWorker():
             a[e > ts] = np.inf
             idx = np.argmin(a)
             
-            if idx == 0:
-                source_file = os.path.join(self.output, self.modulename + '.v')
-                source_file_syn = os.path.join(self.output, self.modulename + '_syn.v')
-            else:
-                source_file = os.path.join(self.output, 'tmp', '{}.v'.format(self.design_list[idx - 1]))
-                source_file_syn = os.path.join(self.output, 'tmp', '{}_syn.v'.format(self.design_list[idx - 1]))
+            source_file, source_file_syn = self.netlists(idx)
 
             target_file = os.path.join(self.output, 'result', '{}_{:%}.v'.format(self.modulename, ts))
             target_file_syn = os.path.join(self.output, 'result', '{}_{:%}_syn.v'.format(self.modulename, ts))
@@ -471,6 +562,17 @@ class GreedyWorker():
         
         changed = []
 
+        # Designs above this error are rejected by optimization()
+        self.error_bound = None if least_error else threshold + 0.01
+
+        evaluate = evaluate_design
+        if self.surrogate:
+            evaluate = evaluate_surrogate
+            if self.glue_area is None:
+                # Area of the top level, so that the surrogate of the
+                # original design is its synthesized area
+                self.glue_area = self.initial_area - sum(variant_area(self, i, k) for i, k in enumerate(self.output_list))
+
         for num_track, curr_k_stream in enumerate(curr_k_streams):
             print('==========TRACK {} =========='.format(num_track))
             # Create a set of candidate k_streams
@@ -496,8 +598,8 @@ class GreedyWorker():
             if accel == 0 or accel == 2: 
                 # Parallel mode
                 if parallel:
-                    pool = mp.Pool(cpu_count)
-                    results = [pool.apply_async(evaluate_design,args=(k_lists_tmp[i], self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i), False )) for i in range(len(k_lists_tmp))]
+                    pool = self.pool(cpu_count)
+                    results = [pool.apply_async(evaluate,args=(k_lists_tmp[i], self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i), False )) for i in range(len(k_lists_tmp))]
                     pool.close()
                     pool.join()
                     for idx, result in enumerate(results):
@@ -516,7 +618,7 @@ class GreedyWorker():
                         # Evaluate each list
                         print('======== Design number ' + str(i))
                         k_stream = k_lists_tmp[i]
-                        res = evaluate_design(k_stream, self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i))
+                        res = evaluate(k_stream, self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i))
                         if res is None:
                             continue
                         err_list.append(res[0])
@@ -538,8 +640,8 @@ class GreedyWorker():
                     k_lists_choice = k_lists_tmp[batch_num*20 : (batch_num+1)*20]
                     # Parallel mode
                     if parallel:
-                        pool = mp.Pool(cpu_count)
-                        results = [pool.apply_async(evaluate_design,args=(k_lists_choice[i], self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i), False )) for i in range(len(k_lists_choice))]
+                        pool = self.pool(cpu_count)
+                        results = [pool.apply_async(evaluate,args=(k_lists_choice[i], self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i), False )) for i in range(len(k_lists_choice))]
                         pool.close()
                         pool.join()
                         for idx, result in enumerate(results):
@@ -558,7 +660,7 @@ class GreedyWorker():
                             # Evaluate each list
                             print('======== Design number ' + str(i))
                             k_stream = k_lists_choice[i]
-                            res = evaluate_design(k_stream, self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i))
+                            res = evaluate(k_stream, self, '{}_{}-{}-{}'.format(self.modulename, num_iter, num_track, i))
                             if res is None:
                                 continue
                             err_list.append(res[0])
@@ -572,7 +674,41 @@ class GreedyWorker():
                     if min(err_list) <= threshold:
                         break
 
-        
+
+        rejected = [i for i, a in enumerate(area_list) if a == np.inf]
+        loops = []
+        if len(area_list) > 0 and len(rejected) == len(area_list):
+            # Every design was rejected before synthesis: synthesize them, their
+            # error already known, so that they are ranked by area as usual
+            if parallel:
+                pool = self.pool(cpu_count)
+                results = [pool.apply_async(synthesize_design, args=(k_lists[i], self, name_list[i])) for i in rejected]
+                pool.close()
+                pool.join()
+                results = [result.get() for result in results]
+            else:
+                results = [synthesize_design(k_lists[i], self, name_list[i]) for i in rejected]
+            for idx, res in zip(rejected, results):
+                if res is None:
+                    loops.append(idx)
+                else:
+                    area_list[idx], delay_list[idx], power_list[idx] = res
+            rejected = []
+
+        # Designs rejected before synthesis are logged apart and neither
+        # ranked nor kept as tracks
+        with open(os.path.join(self.output, 'log', 'rejected.csv'), 'a') as f:
+            for i in rejected:
+                f.write('{},{:.6f}\n'.format(name_list[i], err_list[i]))
+        if len(rejected) + len(loops) > 0:
+            kept = [i for i in range(len(name_list)) if i not in rejected and i not in loops]
+            k_lists = [k_lists[i] for i in kept]
+            name_list = [name_list[i] for i in kept]
+            err_list = [err_list[i] for i in kept]
+            area_list = [area_list[i] for i in kept]
+            delay_list = [delay_list[i] for i in kept]
+            power_list = [power_list[i] for i in kept]
+
         if len(name_list) == 0:
             raise NoValidDesign()
 
@@ -635,6 +771,23 @@ class GreedyWorker():
         return pareto, rank
 
 
+    def netlists(self, idx):
+        '''
+        Netlists of design idx of the lists before and after technology
+        mapping, synthesizing it first if only its surrogate area is known
+        '''
+        if idx == 0:
+            return os.path.join(self.output, self.modulename + '.v'), os.path.join(self.output, self.modulename + '_syn.v')
+
+        name = self.design_list[idx - 1]
+        source_file = os.path.join(self.output, 'tmp', '{}.v'.format(name))
+        if not os.path.exists(source_file) and name in self.stream_of:
+            res = synthesize_design(self.stream_of[name], self, name)
+            if res is not None:
+                self.area_list[idx], self.delay_list[idx], self.power_list[idx] = res
+        return source_file, os.path.join(self.output, 'tmp', '{}_syn.v'.format(name))
+
+
     def store_pareto(self):
 
         area_pareto_dir = os.path.join(self.output, 'result', 'area_pareto_front')
@@ -658,7 +811,7 @@ class GreedyWorker():
         fa.write('{},{},{},{},{}\n'.format('Ranking','Metric','Area(um^2)','Power(uW)', 'Delay(ns)'))
 
         for n, i in enumerate(area_pareto_rank[1:]):
-            source_file = os.path.join(self.output, 'tmp', '{}.v'.format(self.design_list[i-1]))
+            source_file = self.netlists(i)[0]
             target_file = os.path.join(area_pareto_dir, 'area_pareto_{}.v'.format(n+1))
             shutil.copyfile(source_file, target_file)
 
@@ -672,7 +825,7 @@ class GreedyWorker():
         fp.write('{},{},{},{},{}\n'.format('Ranking','Metric','Area(um^2)','Power(uW)', 'Delay(ns)'))
 
         for n, i in enumerate(power_pareto_rank[1:]):
-            source_file = os.path.join(self.output, 'tmp', '{}.v'.format(self.design_list[i-1]))
+            source_file = self.netlists(i)[0]
             target_file = os.path.join(power_pareto_dir, 'power_pareto_{}.v'.format(n+1))
             shutil.copyfile(source_file, target_file)
 
@@ -1,96 +1,288 @@
 import numpy as np
+from math import sqrt, pi
+from statistics import NormalDist
+from .truthtable import open_truth
 
-def HD(original_path, approximate_path):
-    with open(original_path, 'r') as fo:
-        org_line_list = fo.readlines()
-    with open(approximate_path, 'r') as fa:
-        app_line_list = fa.readlines()
-    
-    org = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in org_line_list]
-    app = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in app_line_list]
+# Vectors are processed in chunks of CHUNK rows, so memory does not grow with
+# the number of test vectors. Output words wider than 64 bits are handled as
+# 64-bit limbs, most significant limb first.
+CHUNK = 1 << 16
 
-    if len(org_line_list) != len(app_line_list):
-        print('ERROR! sizes of input files are not equal! Aborting...')
-        return -1
-    org = np.array(org)
-    app = np.array(app)
-    total = org.size
-    HD = np.sum(org != app)
-    return HD/total
 
+def limbs(bits):
+    '''
+    Rows of a 0/1 matrix, first column as MSB, as (rows, limbs) uint64
+    '''
+    rows, cols = bits.shape
+    width = max(1, -(-cols // 64)) * 64
+    padded = np.zeros((rows, width), dtype=np.uint8)
+    padded[:, width-cols:] = bits
+    return np.packbits(padded, axis=1).view('>u8').astype(np.uint64)
 
 
-def MAE(original_path, approximate_path):
-    with open(original_path, 'r') as fo:
-        org_line_list = fo.readlines()
-    with open(approximate_path, 'r') as fa:
-        app_line_list = fa.readlines()
-    
-    org = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in org_line_list]
-    app = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in app_line_list]
+def abs_diff(a, b):
+    '''
+    Row-wise |a - b| of two limb matrices
+    '''
+    # Rows where a > b, deciding on the most significant differing limb
+    greater = np.zeros(a.shape[0], dtype=bool)
+    decided = np.zeros(a.shape[0], dtype=bool)
+    for j in range(a.shape[1]):
+        greater |= ~decided & (a[:, j] > b[:, j])
+        decided |= a[:, j] != b[:, j]
+    hi = np.where(greater[:, None], a, b)
+    lo = np.where(greater[:, None], b, a)
+
+    diff = np.empty_like(hi)
+    borrow = np.zeros(a.shape[0], dtype=np.uint64)
+    for j in range(a.shape[1] - 1, -1, -1):
+        diff[:, j] = hi[:, j] - lo[:, j] - borrow
+        borrow = ((hi[:, j] < lo[:, j]) | ((hi[:, j] == lo[:, j]) & (borrow == 1))).astype(np.uint64)
+    return diff
+
+
+def exact_sum(x):
+    '''
+    Exact sum of the values of a limb matrix as a Python int
+    '''
+    total = 0
+    num_limbs = x.shape[1]
+    for j in range(num_limbs):
+        # Halves of 32 bits cannot overflow over a chunk
+        low = int((x[:, j] & np.uint64(0xFFFFFFFF)).sum(dtype=np.uint64))
+        high = int((x[:, j] >> np.uint64(32)).sum(dtype=np.uint64))
+        total += ((high << 32) + low) << (64 * (num_limbs - 1 - j))
+    return total
+
+
+def to_float(x):
+    '''
+    Values of a limb matrix as float64
+    '''
+    scale = 2.0 ** (64 * np.arange(x.shape[1] - 1, -1, -1))
+    return (x.astype(np.float64) * scale).sum(axis=1)
+
+
+
+# The truth tables given to the metrics are paths or loaded TruthTable
+# objects, such as the ground truth the worker keeps in shared memory.
+#
+# Each metric is a partial sum over (original, approximate) chunks of rows
+# and a function of the total, the number of vectors and the output width.
+
+def hd_partial(org, app):
+    return int(np.count_nonzero(org != app))
+
+
+def hd_result(total, num_vec, num_pos):
+    return total / (num_vec * num_pos)
 
-    if len(org_line_list) != len(app_line_list):
-        print('ERROR! sizes of input files are not equal! Aborting...')
-        return -1
 
-    num_vec = len(org)
-    num_pos = len(org[0])
+def mae_partial(org, app):
+    return exact_sum(abs_diff(limbs(org), limbs(app)))
 
+
+def mae_result(total, num_vec, num_pos):
     maxnum = 2 ** num_pos - 1
+    return (total / num_vec) / maxnum
 
-    err = []
 
-    for i in range(num_vec):
-        orgnum = int(''.join(org[i]), 2)
-        appnum = int(''.join(app[i]), 2)
-        err.append( np.abs(orgnum - appnum) )
+def er_partial(org, app):
+    return int(np.count_nonzero(np.any(org != app, axis=1)))
 
-    return np.mean(err) / maxnum
 
+def er_result(total, num_vec, num_pos):
+    return total / num_vec
 
 
-def ER(original_path, approximate_path):
-    with open(original_path, 'r') as fo:
-        org_line_list = fo.readlines()
-    with open(approximate_path, 'r') as fa:
-        app_line_list = fa.readlines()
-    
-    # org = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in org_line_list]
-    # app = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in app_line_list]
+def mre_partial(org, app):
+    org_limbs = limbs(org)
+    diff = to_float(abs_diff(org_limbs, limbs(app)))
+    return float(np.sum(diff / np.maximum(1.0, to_float(org_limbs))))
 
-    if len(org_line_list) != len(app_line_list):
-        print('ERROR! sizes of input files are not equal! Aborting...')
-        return -1
 
-    num_vec = len(org_line_list)
-    compare = [i != j for i,j in zip(org_line_list, app_line_list)]
+def mre_result(total, num_vec, num_pos):
+    return total / num_vec
 
-    return sum(compare) / num_vec
 
+ACCUMULATORS = {
+    'HD': (hd_partial, hd_result),
+    'MAE': (mae_partial, mae_result),
+    'ER': (er_partial, er_result),
+    'MRE': (mre_partial, mre_result),
+}
 
 
-def MRE(original_path, approximate_path):
-    with open(original_path, 'r') as fo:
-        org_line_list = fo.readlines()
-    with open(approximate_path, 'r') as fa:
-        app_line_list = fa.readlines()
+def accumulate(name, original, approximate_chunks):
+    '''
+    Metric name of approximate rows arriving as an iterable of uint8
+    matrices, folded chunk by chunk against the original truth table, a
+    path or a loaded TruthTable
+    '''
+    partial, result = ACCUMULATORS[name]
+    org = open_truth(original)
+    total = 0
+    start = 0
+    for app in approximate_chunks:
+        stop = start + app.shape[0]
+        if stop > org.rows or app.shape[1] != org.cols:
+            break
+        total += partial(org.read(start, stop), app)
+        start = stop
+    else:
+        if start == org.rows:
+            return result(total, org.rows, org.cols)
+    print('ERROR! sizes of input files are not equal! Aborting...')
+    return -1
 
-    org = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in org_line_list]
-    app = [list(filter(lambda a: a != ' ', list(i[:-1]))) for i in app_line_list]
 
-    if len(org_line_list) != len(app_line_list):
-        print('ERROR! sizes of input files are not equal! Aborting...')
-        return -1
-    num_vec = len(org)
-    num_pos = len(org[0])
 
-    maxnum = 2 ** num_pos - 1
+# Per-vector values in [0, 1] whose mean is the metric, used to estimate
+# the metric from a prefix of randomly drawn vectors.
+
+def hd_samples(org, app):
+    return np.count_nonzero(org != app, axis=1) / org.shape[1]
+
+
+def er_samples(org, app):
+    return np.any(org != app, axis=1).astype(np.float64)
+
+
+def mae_samples(org, app):
+    return to_float(abs_diff(limbs(org), limbs(app))) / (2.0 ** org.shape[1] - 1)
+
+
+SAMPLES = {
+    'HD': hd_samples,
+    'ER': er_samples,
+    'MAE': mae_samples,
+}
+
 
-    err = []
+def estimate(name, original, approximate_chunks, bound, confidence=0.999, min_vectors=1024):
+    '''
+    Like accumulate, for testbenches of vectors in random order. Keeps a
+    running confidence interval of the metric and stops reading chunks as
+    soon as its lower end lies above bound, returning the mean of the
+    vectors seen so far. Designs that are not rejected get the exact value.
+    The interval is checked after every chunk, so the j-th check spends
+    (1 - confidence) * 6 / (pi^2 j^2) of the error, which sums to
+    1 - confidence over all checks.
+    '''
+    partial, result = ACCUMULATORS[name]
+    samples = SAMPLES[name]
+    looks = 0
+    org = open_truth(original)
+    total = 0
+    start = 0
+    mean_sum = 0.0
+    square_sum = 0.0
+    for app in approximate_chunks:
+        stop = start + app.shape[0]
+        if stop > org.rows or app.shape[1] != org.cols:
+            break
+        org_rows = org.read(start, stop)
+        total += partial(org_rows, app)
+        x = samples(org_rows, app)
+        mean_sum += float(x.sum())
+        square_sum += float(np.dot(x, x))
+        start = stop
 
-    for i in range(num_vec):
-        orgnum = int(''.join(org[i]), 2)
-        appnum = int(''.join(app[i]), 2)
-        err.append( np.abs(orgnum - appnum) / np.max((1, orgnum)) )
+        if min_vectors <= start < org.rows:
+            looks += 1
+            z = NormalDist().inv_cdf(1 - (1 - confidence) * 6 / (pi * pi * looks * looks))
+            mean = mean_sum / start
+            variance = max(0.0, square_sum / start - mean * mean) * start / (start - 1)
+            if mean - z * sqrt(variance / start) > bound:
+                return mean
+    else:
+        if start == org.rows:
+            return result(total, org.rows, org.cols)
+    print('ERROR! sizes of input files are not equal! Aborting...')
+    return -1
 
-    return np.mean(err)
+
+def limbs_max(x):
+    '''
+    Largest value of a limb matrix as a Python int
+    '''
+    if x.shape[0] == 0:
+        return 0
+    values = to_float(x)
+    best = 0
+    for row in x[values == values.max()]:
+        best = max(best, sum(int(v) << (64 * j) for j, v in enumerate(row[::-1])))
+    return best
+
+
+# Metrics computed by distance(). MAE, WCE and MSE are absolute values of
+# the output words; MAE% and WCE% are divided by the largest output word.
+DISTANCE = ['HD', 'MAE', 'MAE%', 'ER', 'MRE', 'WCE', 'WCE%', 'MSE']
+
+# Entry of distance() equal to each metric function
+DISTANCE_OF = {'HD': 'HD', 'MAE': 'MAE%', 'ER': 'ER', 'MRE': 'MRE'}
+
+
+def distance_chunks(original, approximate_chunks):
+    '''
+    Every metric of DISTANCE in one pass over approximate rows arriving as
+    an iterable of uint8 matrices, against the original truth table.
+    Returns the names and the values.
+    '''
+    org = open_truth(original)
+    hd = 0
+    wrong = 0
+    abs_sum = 0
+    square_sum = 0.0
+    relative = 0.0
+    worst = 0
+    start = 0
+    for app in approximate_chunks:
+        stop = start + app.shape[0]
+        if stop > org.rows or app.shape[1] != org.cols:
+            break
+        org_rows = org.read(start, stop)
+        differ = org_rows != app
+        hd += int(np.count_nonzero(differ))
+        wrong += int(np.count_nonzero(np.any(differ, axis=1)))
+
+        org_limbs = limbs(org_rows)
+        diff = abs_diff(org_limbs, limbs(app))
+        abs_sum += exact_sum(diff)
+        worst = max(worst, limbs_max(diff))
+        diff_float = to_float(diff)
+        square_sum += float(np.dot(diff_float, diff_float))
+        relative += float(np.sum(diff_float / np.maximum(1.0, to_float(org_limbs))))
+        start = stop
+    else:
+        if start == org.rows:
+            num_vec, num_pos = org.shape
+            maxnum = 2 ** num_pos - 1
+            values = [hd / (num_vec * num_pos), abs_sum / num_vec, (abs_sum / num_vec) / maxnum, wrong / num_vec,
+                      relative / num_vec, worst, worst / maxnum, square_sum / num_vec]
+            return DISTANCE, values
+    print('ERROR! sizes of input files are not equal! Aborting...')
+    return DISTANCE, [-1] * len(DISTANCE)
+
+
+def distance(original_path, approximate_path):
+    return distance_chunks(original_path, open_truth(approximate_path).chunks(CHUNK))
+
+
+def HD(original_path, approximate_path):
+    return accumulate('HD', original_path, open_truth(approximate_path).chunks(CHUNK))
+
+
+
+def MAE(original_path, approximate_path):
+    return accumulate('MAE', original_path, open_truth(approximate_path).chunks(CHUNK))
+
+
+
+def ER(original_path, approximate_path):
+    return accumulate('ER', original_path, open_truth(approximate_path).chunks(CHUNK))
+
+
+
+def MRE(original_path, approximate_path):
+    return accumulate('MRE', original_path, open_truth(approximate_path).chunks(CHUNK))
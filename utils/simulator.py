@@ -0,0 +1,802 @@
+import regex as re
+import os
+import numpy as np
+from .ASSO import bitpack
+
+# Bit-parallel simulation of combinational gate-level Verilog. Every bit of a
+# signal holds one uint64 word per 64 test vectors, so each gate of the
+# netlist costs a single NumPy bitwise operation over all vectors.
+
+
+class SimulationError(Exception):
+    pass
+
+
+class LoopError(SimulationError):
+    pass
+
+
+_TOKEN = re.compile(r'''
+    \\(?P<escaped>\S+)
+  | (?P<number>\d*\s*'[sS]?[bBoOdDhH]\s*[0-9a-fA-FxXzZ_?]+ | \d+)
+  | (?P<name>[A-Za-z_$][A-Za-z0-9_$]*)
+  | (?P<op>~\^|\^~|~&|~\||&&|\|\||==|!=|[~!&|^?:()\[\]{},;=.\#])
+  | (?P<space>\s+)
+  | (?P<error>.)
+''', re.VERBOSE)
+
+_PRIMITIVES = {'and', 'or', 'nand', 'nor', 'xor', 'xnor', 'not', 'buf'}
+
+# Yosys internal gate cells as (inputs, expression builder)
+_CELLS = {
+    '$_BUF_': ('A', lambda p: p['A']),
+    '$_NOT_': ('A', lambda p: ('un', '~', p['A'])),
+    '$_AND_': ('AB', lambda p: ('bin', '&', p['A'], p['B'])),
+    '$_NAND_': ('AB', lambda p: ('un', '~', ('bin', '&', p['A'], p['B']))),
+    '$_OR_': ('AB', lambda p: ('bin', '|', p['A'], p['B'])),
+    '$_NOR_': ('AB', lambda p: ('un', '~', ('bin', '|', p['A'], p['B']))),
+    '$_XOR_': ('AB', lambda p: ('bin', '^', p['A'], p['B'])),
+    '$_XNOR_': ('AB', lambda p: ('un', '~', ('bin', '^', p['A'], p['B']))),
+    '$_ANDNOT_': ('AB', lambda p: ('bin', '&', p['A'], ('un', '~', p['B']))),
+    '$_ORNOT_': ('AB', lambda p: ('bin', '|', p['A'], ('un', '~', p['B']))),
+    '$_MUX_': ('ABS', lambda p: ('cond', p['S'], p['B'], p['A'])),
+    '$_NMUX_': ('ABS', lambda p: ('un', '~', ('cond', p['S'], p['B'], p['A']))),
+    '$_AOI3_': ('ABC', lambda p: ('un', '~', ('bin', '|', ('bin', '&', p['A'], p['B']), p['C']))),
+    '$_OAI3_': ('ABC', lambda p: ('un', '~', ('bin', '&', ('bin', '|', p['A'], p['B']), p['C']))),
+    '$_AOI4_': ('ABCD', lambda p: ('un', '~', ('bin', '|', ('bin', '&', p['A'], p['B']), ('bin', '&', p['C'], p['D'])))),
+    '$_OAI4_': ('ABCD', lambda p: ('un', '~', ('bin', '&', ('bin', '|', p['A'], p['B']), ('bin', '|', p['C'], p['D'])))),
+}
+
+
+def tokenize(text):
+    text = re.sub(r'/\*.*?\*/', ' ', text, flags=re.DOTALL)
+    text = re.sub(r'//[^\n]*', ' ', text)
+    tokens = []
+    for m in _TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind == 'space':
+            continue
+        if kind == 'error':
+            raise SimulationError('Unexpected character {!r}'.format(m.group(0)))
+        if kind == 'escaped':
+            tokens.append(('name', m.group('escaped')))
+        else:
+            tokens.append((kind, m.group(0)))
+    return tokens
+
+
+def parse_number(text):
+    '''
+    Bits of a Verilog literal, LSB first. x and z are left to iverilog,
+    which prints them rather than reading them as 0.
+    '''
+    text = re.sub(r'[\s_]', '', text)
+    if "'" not in text:
+        value = int(text)
+        return [(value >> i) & 1 for i in range(32)]
+
+    size, rest = text.split("'")
+    base = rest.lstrip('sS')[0].lower()
+    digits = rest.lstrip('sS')[1:].lower()
+    if re.search('[xz?]', digits):
+        raise SimulationError('x/z literal {}'.format(text))
+    if base == 'd':
+        value = int(digits)
+        width = int(size) if size else 32
+    else:
+        bits_per_digit = {'b': 1, 'o': 3, 'h': 4}[base]
+        value = int(digits, 1 << bits_per_digit)
+        width = int(size) if size else len(digits) * bits_per_digit
+    return [(value >> i) & 1 for i in range(width)]
+
+
+def signal_indices(ranges, name):
+    '''
+    Bit indices of a signal, LSB first. Undeclared signals are one bit wide.
+    '''
+    msb, lsb = ranges.get(name, (0, 0))
+    step = 1 if msb >= lsb else -1
+    return list(range(lsb, msb + step, step))
+
+
+def lvalue_bits(ranges, e):
+    '''
+    Signal bits (name, index) of an lvalue, LSB first
+    '''
+    kind = e[0]
+    if kind == 'id':
+        return [(e[1], i) for i in signal_indices(ranges, e[1])]
+    if kind == 'sel':
+        return [(e[1], e[2])]
+    if kind == 'part':
+        step = 1 if e[2] >= e[3] else -1
+        return [(e[1], i) for i in range(e[3], e[2] + step, step)]
+    if kind == 'cat':
+        result = []
+        for item in reversed(e[1]):
+            result += lvalue_bits(ranges, item)
+        return result
+    raise SimulationError('Invalid assignment target')
+
+
+class Parser():
+    '''
+    Recursive-descent parser of the statements of one module
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset][1]
+        return None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise SimulationError('Unexpected end of file')
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise SimulationError('Expected {} but found {}'.format(value, token))
+
+    def name(self):
+        kind, token = self.next()
+        if kind != 'name':
+            raise SimulationError('Expected identifier but found {}'.format(token))
+        return token
+
+    def integer(self):
+        kind, token = self.next()
+        if kind != 'number':
+            raise SimulationError('Expected constant but found {}'.format(token))
+        bits = parse_number(token)
+        return sum(b << i for i, b in enumerate(bits))
+
+    def expression(self):
+        cond = self.binary(0)
+        if self.peek() == '?':
+            self.next()
+            a = self.expression()
+            self.expect(':')
+            b = self.expression()
+            return ('cond', cond, a, b)
+        return cond
+
+    # Binary operators from the lowest precedence up
+    LEVELS = [('||',), ('&&',), ('|', '~|'), ('^', '~^', '^~'), ('&', '~&'), ('==', '!=')]
+
+    def binary(self, level):
+        if level == len(self.LEVELS):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek() in self.LEVELS[level]:
+            op = self.next()[1]
+            right = self.binary(level + 1)
+            left = ('bin', op, left, right)
+        return left
+
+    def unary(self):
+        if self.peek() in ('~', '!', '&', '|', '^', '~&', '~|', '~^', '^~'):
+            op = self.next()[1]
+            return ('un', op, self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, token = self.next()
+        if token == '(':
+            e = self.expression()
+            self.expect(')')
+            return e
+        if token == '{':
+            first = self.expression()
+            if self.peek() == '{':
+                # Replication {n{...}}
+                self.next()
+                items = [self.expression()]
+                while self.peek() == ',':
+                    self.next()
+                    items.append(self.expression())
+                self.expect('}')
+                self.expect('}')
+                if first[0] != 'const':
+                    raise SimulationError('Replication count must be constant')
+                count = sum(b << i for i, b in enumerate(first[1]))
+                return ('cat', [('cat', items)] * count)
+            items = [first]
+            while self.peek() == ',':
+                self.next()
+                items.append(self.expression())
+            self.expect('}')
+            return ('cat', items)
+        if kind == 'number':
+            return ('const', parse_number(token))
+        if kind == 'name':
+            if self.peek() == '[':
+                self.next()
+                msb = self.integer()
+                if self.peek() == ':':
+                    self.next()
+                    lsb = self.integer()
+                    self.expect(']')
+                    return ('part', token, msb, lsb)
+                self.expect(']')
+                return ('sel', token, msb)
+            return ('id', token)
+        raise SimulationError('Unexpected token {}'.format(token))
+
+    def connections(self):
+        '''
+        Port list of an instance as a list (positional) or dict (named)
+        '''
+        self.expect('(')
+        if self.peek() == ')':
+            self.next()
+            return []
+        if self.peek() == '.':
+            named = {}
+            while True:
+                self.expect('.')
+                port = self.name()
+                self.expect('(')
+                if self.peek() == ')':
+                    named[port] = None
+                else:
+                    named[port] = self.expression()
+                self.expect(')')
+                if self.peek() != ',':
+                    break
+                self.next()
+            self.expect(')')
+            return named
+        ordered = [self.expression()]
+        while self.peek() == ',':
+            self.next()
+            ordered.append(self.expression())
+        self.expect(')')
+        return ordered
+
+
+class Module():
+    def __init__(self, name):
+        self.name = name
+        self.ports = []
+        self.inputs = []
+        self.outputs = []
+        self.ranges = {}
+        self.assigns = []
+        self.instances = []
+
+
+def parse_verilog(text):
+    '''
+    Parse the modules of a structural Verilog file. Returns {name: Module}.
+    '''
+    p = Parser(tokenize(text))
+    modules = {}
+    while p.peek() is not None:
+        p.expect('module')
+        module = Module(p.name())
+        modules[module.name] = module
+
+        if p.peek() == '(':
+            p.next()
+            while p.peek() != ')':
+                token = p.next()[1]
+                if token in ('input', 'output', 'wire'):
+                    raise SimulationError('ANSI port declarations are not supported')
+                if token != ',':
+                    module.ports.append(token)
+            p.next()
+        p.expect(';')
+
+        while p.peek() != 'endmodule':
+            keyword = p.next()[1]
+            if keyword in ('input', 'output', 'wire', 'reg', 'inout'):
+                if keyword == 'inout':
+                    raise SimulationError('inout ports are not supported')
+                if p.peek() in ('wire', 'reg', 'signed'):
+                    p.next()
+                msb, lsb = 0, 0
+                if p.peek() == '[':
+                    p.next()
+                    msb = p.integer()
+                    p.expect(':')
+                    lsb = p.integer()
+                    p.expect(']')
+                while True:
+                    name = p.name()
+                    module.ranges[name] = (msb, lsb)
+                    if keyword == 'input':
+                        module.inputs.append(name)
+                    elif keyword == 'output':
+                        module.outputs.append(name)
+                    if p.peek() == '=':
+                        # Net declaration assignment
+                        p.next()
+                        module.assigns.append((('id', name), p.expression()))
+                    if p.peek() != ',':
+                        break
+                    p.next()
+                p.expect(';')
+
+            elif keyword == 'assign':
+                while True:
+                    lhs = p.primary()
+                    p.expect('=')
+                    module.assigns.append((lhs, p.expression()))
+                    if p.peek() != ',':
+                        break
+                    p.next()
+                p.expect(';')
+
+            elif keyword in _PRIMITIVES:
+                if p.peek() == '#':
+                    raise SimulationError('Gate delays are not supported')
+                if p.peek() != '(':
+                    p.name()
+                terminals = p.connections()
+                if keyword in ('not', 'buf'):
+                    for out in terminals[:-1]:
+                        rhs = terminals[-1] if keyword == 'buf' else ('un', '~', terminals[-1])
+                        module.assigns.append((out, rhs))
+                else:
+                    op = {'and': '&', 'nand': '&', 'or': '|', 'nor': '|', 'xor': '^', 'xnor': '^'}[keyword]
+                    rhs = terminals[1]
+                    for t in terminals[2:]:
+                        rhs = ('bin', op, rhs, t)
+                    if keyword in ('nand', 'nor', 'xnor'):
+                        rhs = ('un', '~', rhs)
+                    module.assigns.append((terminals[0], rhs))
+                p.expect(';')
+
+            elif keyword in ('always', 'initial', 'function', 'task', 'generate', 'parameter', 'localparam'):
+                raise SimulationError('Behavioural construct {} is not supported'.format(keyword))
+
+            else:
+                # Cell or module instance
+                if p.peek() == '#':
+                    raise SimulationError('Parameterized instances are not supported')
+                inst_name = p.name()
+                module.instances.append((keyword, inst_name, p.connections()))
+                p.expect(';')
+
+        p.expect('endmodule')
+    return modules
+
+
+def _rename(e, prefix):
+    kind = e[0]
+    if kind == 'id':
+        return ('id', prefix + e[1])
+    if kind == 'sel':
+        return ('sel', prefix + e[1], e[2])
+    if kind == 'part':
+        return ('part', prefix + e[1], e[2], e[3])
+    if kind == 'const':
+        return e
+    if kind == 'un':
+        return ('un', e[1], _rename(e[2], prefix))
+    if kind == 'bin':
+        return ('bin', e[1], _rename(e[2], prefix), _rename(e[3], prefix))
+    if kind == 'cond':
+        return ('cond', _rename(e[1], prefix), _rename(e[2], prefix), _rename(e[3], prefix))
+    if kind == 'call':
+        return ('call', e[1], [_rename(x, prefix) for x in e[2]])
+    return ('cat', [_rename(x, prefix) for x in e[1]])
+
+
+class TableBox():
+    '''
+    Module evaluated by table lookup instead of by its netlist. All ports are
+    scalar; the input ports in header order form the row index, the first
+    being the MSB, and column c of the (2^n, m) table drives the c-th output
+    port, as in the truth tables simulated by gen_truth.
+    '''
+    def __init__(self, module, table):
+        self.ports = module.ports
+        self.inputs = [p for p in module.ports if p in module.inputs]
+        self.outputs = [p for p in module.ports if p in module.outputs]
+        for p in self.ports:
+            if module.ranges.get(p, (0, 0))[0] != module.ranges.get(p, (0, 0))[1]:
+                raise SimulationError('Vector port {} of {}'.format(p, module.name))
+        if table.shape != (1 << len(self.inputs), len(self.outputs)):
+            raise SimulationError('Truth table of {} does not match its ports'.format(module.name))
+        # Rows packed to bytes to keep many tables in memory
+        self.table = np.packbits(table, axis=1)
+
+    def evaluate(self, inputs, words):
+        n = len(self.inputs)
+        index = np.zeros(words * bitpack.WORD, dtype=np.int64)
+        for k, x in enumerate(inputs):
+            bits = np.unpackbits(np.ascontiguousarray(x, dtype='<u8').view(np.uint8), bitorder='little')
+            index |= bits.astype(np.int64) << (n - 1 - k)
+        out = np.unpackbits(self.table[index], axis=1)[:, :len(self.outputs)]
+        return list(bitpack.pack_columns(out))
+
+
+class Netlist():
+    '''
+    A flattened module: signal ranges and the assignments driving each bit
+    '''
+    def __init__(self, modules, top, boxes=None):
+        if top not in modules:
+            raise SimulationError('Module {} not found'.format(top))
+        self.top = modules[top]
+        self.boxes = boxes if boxes is not None else {}
+        self.ranges = {}
+        self.assigns = []
+        self._flatten(modules, self.top, '', [])
+        self._order()
+
+    def _flatten(self, modules, module, prefix, stack):
+        if module.name in stack:
+            raise SimulationError('Recursive instance of {}'.format(module.name))
+        for name, r in module.ranges.items():
+            self.ranges[prefix + name] = r
+        for lhs, rhs in module.assigns:
+            self.assigns.append((_rename(lhs, prefix), _rename(rhs, prefix)))
+
+        for cell, inst_name, conns in module.instances:
+            inst_prefix = prefix + inst_name + '.'
+            if cell in _CELLS:
+                inputs, build = _CELLS[cell]
+                if not isinstance(conns, dict) or 'Y' not in conns:
+                    raise SimulationError('Cell {} needs named ports'.format(inst_name))
+                args = {pin: _rename(conns[pin], prefix) for pin in inputs}
+                self.assigns.append((_rename(conns['Y'], prefix), build(args)))
+                continue
+            if cell in self.boxes:
+                box = self.boxes[cell]
+                if isinstance(conns, list):
+                    conns = dict(zip(box.ports, conns))
+                args = [_rename(conns[p], prefix) if conns.get(p) is not None else ('const', [0]) for p in box.inputs]
+                outs = [_rename(conns[p], prefix) if conns.get(p) is not None else ('id', inst_prefix + p) for p in box.outputs]
+                self.assigns.append((('cat', outs[::-1]), ('call', box, args)))
+                continue
+            if cell not in modules:
+                raise SimulationError('Unknown cell {}'.format(cell))
+
+            child = modules[cell]
+            if isinstance(conns, list):
+                conns = dict(zip(child.ports, conns))
+            self._flatten(modules, child, inst_prefix, stack + [module.name])
+            for port, e in conns.items():
+                if e is None:
+                    continue
+                if port in child.inputs:
+                    self.assigns.append((('id', inst_prefix + port), _rename(e, prefix)))
+                elif port in child.outputs:
+                    self.assigns.append((_rename(e, prefix), ('id', inst_prefix + port)))
+                else:
+                    raise SimulationError('Unknown port {} of {}'.format(port, cell))
+
+    def bits(self, e):
+        return lvalue_bits(self.ranges, e)
+
+    def depends(self, e, result):
+        kind = e[0]
+        if kind in ('id', 'sel', 'part'):
+            result.extend(self.bits(e))
+        elif kind == 'un':
+            self.depends(e[2], result)
+        elif kind == 'bin':
+            self.depends(e[2], result)
+            self.depends(e[3], result)
+        elif kind == 'cond':
+            for x in e[1:]:
+                self.depends(x, result)
+        elif kind == 'cat':
+            for x in e[1]:
+                self.depends(x, result)
+        elif kind == 'call':
+            for x in e[2]:
+                self.depends(x, result)
+        return result
+
+    def _order(self):
+        # Topological order of the assignments
+        driver = {}
+        targets = []
+        for idx, (lhs, rhs) in enumerate(self.assigns):
+            bits = self.bits(lhs)
+            targets.append(bits)
+            for b in bits:
+                if b in driver:
+                    raise SimulationError('Multiple drivers of {}[{}]'.format(*b))
+                driver[b] = idx
+
+        fanout = [[] for _ in self.assigns]
+        pending = [0] * len(self.assigns)
+        for idx, (lhs, rhs) in enumerate(self.assigns):
+            for d in set(driver[b] for b in self.depends(rhs, []) if b in driver):
+                fanout[d].append(idx)
+                pending[idx] += 1
+
+        ready = [idx for idx in range(len(self.assigns)) if pending[idx] == 0]
+        order = []
+        while len(ready) > 0:
+            idx = ready.pop()
+            order.append(idx)
+            for f in fanout[idx]:
+                pending[f] -= 1
+                if pending[f] == 0:
+                    ready.append(f)
+
+        if len(order) != len(self.assigns):
+            raise LoopError('Combinational loop')
+        self.order = [(targets[idx], self.assigns[idx][1]) for idx in order]
+
+    def simulate(self, inputs, words):
+        '''
+        inputs maps (name, index) of the top-level input bits to word arrays.
+        Returns the values of every signal bit.
+        '''
+        zero = np.zeros(words, dtype=np.uint64)
+        one = ~zero
+        values = dict(inputs)
+
+        def reduce_or(bits):
+            result = bits[0]
+            for b in bits[1:]:
+                result = result | b
+            return result
+
+        def evaluate(e):
+            kind = e[0]
+            if kind in ('id', 'sel', 'part'):
+                return [values.get(b, zero) for b in self.bits(e)]
+            if kind == 'const':
+                return [one if b else zero for b in e[1]]
+            if kind == 'cat':
+                result = []
+                for item in reversed(e[1]):
+                    result += evaluate(item)
+                return result
+            if kind == 'call':
+                # Scalar ports take the LSB of their connection
+                return e[1].evaluate([evaluate(x)[0] for x in e[2]], words)
+            if kind == 'cond':
+                c = reduce_or(evaluate(e[1]))
+                a = evaluate(e[2])
+                b = evaluate(e[3])
+                width = max(len(a), len(b))
+                a += [zero] * (width - len(a))
+                b += [zero] * (width - len(b))
+                return [(c & x) | (~c & y) for x, y in zip(a, b)]
+            if kind == 'un':
+                op = e[1]
+                a = evaluate(e[2])
+                if op == '~':
+                    return [~x for x in a]
+                if op == '!':
+                    return [~reduce_or(a)]
+                result = a[0]
+                for x in a[1:]:
+                    if op in ('&', '~&'):
+                        result = result & x
+                    elif op in ('|', '~|'):
+                        result = result | x
+                    else:
+                        result = result ^ x
+                if op in ('~&', '~|', '~^', '^~'):
+                    result = ~result
+                return [result]
+
+            op = e[1]
+            a = evaluate(e[2])
+            b = evaluate(e[3])
+            if op in ('&&', '||'):
+                a = reduce_or(a)
+                b = reduce_or(b)
+                return [a & b if op == '&&' else a | b]
+            width = max(len(a), len(b))
+            a += [zero] * (width - len(a))
+            b += [zero] * (width - len(b))
+            if op in ('==', '!='):
+                diff = reduce_or([x ^ y for x, y in zip(a, b)])
+                return [~diff if op == '==' else diff]
+            if op in ('&', '~&'):
+                result = [x & y for x, y in zip(a, b)]
+            elif op in ('|', '~|'):
+                result = [x | y for x, y in zip(a, b)]
+            else:
+                result = [x ^ y for x, y in zip(a, b)]
+            if op in ('~&', '~|', '~^', '^~'):
+                result = [~x for x in result]
+            return result
+
+        for bits, rhs in self.order:
+            result = evaluate(rhs)
+            for i, b in enumerate(bits):
+                values[b] = result[i] if i < len(result) else zero
+        return values
+
+
+_modules = {}
+
+
+def read_modules(path, cache=False):
+    '''
+    Modules of a Verilog file. With cache, parsed files are kept for the life
+    of the process.
+    '''
+    if not cache:
+        with open(path) as f:
+            return parse_verilog(f.read())
+
+    mtime = os.path.getmtime(path)
+    if path not in _modules or _modules[path][0] != mtime:
+        with open(path) as f:
+            _modules[path] = (mtime, parse_verilog(f.read()))
+    return _modules[path][1]
+
+
+_testbenches = {}
+
+
+def read_vectors(path, width, base):
+    '''
+    Vector file as read by $readmemb or $readmemh, one value per line, as a
+    (vectors, width) uint8 matrix, column 0 being the LSB
+    '''
+    with open(path) as f:
+        lines = [l.split('//')[0].strip().replace('_', '') for l in f]
+    lines = [l for l in lines if l != '']
+    if any(l.startswith('@') for l in lines):
+        raise SimulationError('Addresses in vector files are not supported')
+    if base == 'b' and all(len(l) == width for l in lines):
+        # Fast path for binary vectors, MSB first
+        chars = np.frombuffer(''.join(lines).encode(), dtype=np.uint8)
+        return (chars.reshape(len(lines), width) - ord('0'))[:, ::-1]
+    matrix = np.zeros((len(lines), width), dtype=np.uint8)
+    for r, l in enumerate(lines):
+        value = int(l, 2 if base == 'b' else 16)
+        for t in range(width):
+            matrix[r, t] = (value >> t) & 1
+    return matrix
+
+
+def read_testbench(path):
+    '''
+    Stimulus of a testbench that assigns test vectors to one reg, prints
+    one wire with %b after each vector and instantiates the design under
+    test, as written by create_tb and gen_truth. The vectors are either
+    assigned one statement each or loaded from a vector file with
+    $readmemb/$readmemh. Returns the instance (module, connections), the
+    reg and wire names with their ranges and the test vectors as a
+    (vectors, reg width) uint8 matrix, column 0 being the LSB of the reg.
+    Parsed testbenches are kept for the life of the process.
+    '''
+    mtime = os.path.getmtime(path)
+    if path in _testbenches and _testbenches[path][0] == mtime:
+        vector_file, vector_mtime, result = _testbenches[path][1:]
+        if vector_file is None or os.path.getmtime(vector_file) == vector_mtime:
+            return result
+
+    with open(path) as f:
+        text = f.read()
+
+    decls = dict()
+    for kind, msb, lsb, name in re.findall(r'\b(reg|wire)\s*(?:\[\s*(\d+)\s*:\s*(\d+)\s*\])?\s*(\w+)\s*;', text):
+        decls[name] = (int(msb or 0), int(lsb or 0))
+
+    displays = re.findall(r'\$(?:display\s*\(|fwrite\s*\(\s*[^,]+,)\s*"%b(?:\\n)?"\s*,\s*(\w+)\s*\)', text)
+    readmem = re.findall(r'\$readmem([bh])\s*\(\s*"([^"]*)"\s*,\s*(\w+)\s*\)', text)
+    vector_file = None
+    if len(readmem) == 1:
+        # Vectors loaded into a memory and applied in a loop
+        base, vector_file, memory = readmem[0]
+        assigned = re.findall(r'\b(\w+)\s*=\s*' + memory + r'\s*\[', text)
+        if len(assigned) != 1 or len(set(displays)) != 1 or assigned[0] not in decls:
+            raise SimulationError('Unsupported testbench format')
+        reg = assigned[0]
+        width = abs(decls[reg][0] - decls[reg][1]) + 1
+        matrix = read_vectors(vector_file, width, base)
+    else:
+        vectors = re.findall(r"\b(\w+)\s*=\s*(\d+)'([bBhH])([0-9a-fA-F_]+)\s*;", text)
+        if len(vectors) == 0 or len(set(v[0] for v in vectors)) != 1 or len(set(displays)) != 1 or len(displays) != len(vectors):
+            raise SimulationError('Unsupported testbench format')
+        reg = vectors[0][0]
+        if reg not in decls:
+            raise SimulationError('Unsupported testbench format')
+        width = abs(decls[reg][0] - decls[reg][1]) + 1
+        if all(base in 'bB' and len(digits) == width for name, size, base, digits in vectors):
+            # Fast path for binary vectors, MSB first
+            chars = np.frombuffer(''.join(v[3] for v in vectors).encode(), dtype=np.uint8)
+            matrix = (chars.reshape(len(vectors), width) - ord('0'))[:, ::-1]
+        else:
+            matrix = np.zeros((len(vectors), width), dtype=np.uint8)
+            for r, (name, size, base, digits) in enumerate(vectors):
+                value = int(digits.replace('_', ''), 2 if base in 'bB' else 16)
+                for t in range(width):
+                    matrix[r, t] = (value >> t) & 1
+    wire = displays[0]
+    if wire not in decls:
+        raise SimulationError('Unsupported testbench format')
+
+    # Instance of the design under test
+    body = re.sub(r'/\*.*?\*/|//[^\n]*', ' ', text, flags=re.DOTALL)
+    instance = None
+    for statement in body.split(';'):
+        m = re.match(r'\s*(\\\S+|[A-Za-z_]\w*)\s+(\\\S+|[A-Za-z_]\w*)\s*\(', statement)
+        if m and m.group(1) not in ('module', 'reg', 'wire', 'initial', 'begin', 'assign', 'integer'):
+            p = Parser(tokenize(statement[m.end(2):]))
+            instance = (m.group(1).lstrip('\\'), p.connections())
+            break
+    if instance is None:
+        raise SimulationError('No design instance in testbench')
+
+    result = instance, (reg, decls[reg]), (wire, decls[wire]), np.ascontiguousarray(matrix, dtype=np.uint8)
+    vector_mtime = None if vector_file is None else os.path.getmtime(vector_file)
+    _testbenches[path] = (mtime, vector_file, vector_mtime, result)
+    return result
+
+
+def testbench_netlist(netlist, testbench, boxes=None):
+    '''
+    Netlist of the design under test of a testbench, to simulate it on
+    several slices of the vectors without flattening it again
+    '''
+    if isinstance(testbench, str):
+        testbench = read_testbench(testbench)
+    modules = read_modules(netlist) if isinstance(netlist, str) else netlist
+    return Netlist(modules, testbench[0][0], boxes)
+
+
+def simulate_testbench(netlist, testbench, boxes=None, vectors=None):
+    '''
+    Simulate a netlist on the vectors of a testbench. netlist is a Verilog
+    path, a dict of parsed modules or a Netlist built by testbench_netlist,
+    testbench a path or the result of read_testbench, boxes maps module
+    names to TableBox objects and vectors, a slice, restricts the
+    simulation to some of the vectors.
+    Returns the displayed values as a (vectors, width) uint8 matrix, MSB
+    first as printed by %b.
+    '''
+    if isinstance(testbench, str):
+        testbench = read_testbench(testbench)
+    (module, conns), (reg, reg_range), (wire, wire_range), stimulus = testbench
+    if vectors is not None:
+        stimulus = stimulus[vectors]
+
+    if not isinstance(netlist, Netlist):
+        netlist = testbench_netlist(netlist, testbench, boxes)
+    top = netlist.top
+    if isinstance(conns, list):
+        conns = dict(zip(top.ports, conns))
+
+    tb_ranges = {reg: reg_range, wire: wire_range}
+    rows = stimulus.shape[0]
+    words = bitpack.num_words(rows)
+    zero = np.zeros(words, dtype=np.uint64)
+    packed = bitpack.pack_columns(stimulus)
+    reg_bits = {(reg, i): packed[c] for c, i in enumerate(sorted(signal_indices(tb_ranges, reg)))}
+
+    inputs = {}
+    for port, e in conns.items():
+        if port not in top.inputs or e is None:
+            continue
+        src = lvalue_bits(tb_ranges, e)
+        for i, b in enumerate(signal_indices(top.ranges, port)):
+            inputs[(port, b)] = reg_bits.get(src[i], zero) if i < len(src) else zero
+
+    values = netlist.simulate(inputs, words)
+
+    wire_bits = {}
+    for port, e in conns.items():
+        if port not in top.outputs or e is None:
+            continue
+        src = signal_indices(top.ranges, port)
+        for i, b in enumerate(lvalue_bits(tb_ranges, e)):
+            if i < len(src):
+                wire_bits[b] = values.get((port, src[i]), zero)
+
+    # %b prints the MSB first
+    order = sorted(signal_indices(tb_ranges, wire), reverse=True)
+    out = np.stack([wire_bits.get((wire, i), zero) for i in order])
+    return bitpack.unpack_columns(out, rows)
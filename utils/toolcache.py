@@ -0,0 +1,162 @@
+import os
+import sys
+import shutil
+import pickle
+import hashlib
+import subprocess
+from .cache import evict
+
+# Memoization of external tool runs (yosys, ABC, iverilog, OpenSTA) shared by
+# runs and processes. A run is addressed by the tool, its arguments and the
+# contents of its input files. The paths of the declared input and output
+# files are replaced by placeholders in the arguments and in the input files,
+# such as the STA scripts naming the netlist and liberty they read. The same
+# synthesis of a design written to another file, or in another output
+# directory, is then a hit. An entry holds the return code, what the tool
+# printed and the contents of its output files, which are written again on a
+# hit.
+#
+# The cache is off unless configure() is called, and call() then runs the
+# tool as subprocess.call does.
+
+
+class ToolCache():
+    '''
+    On-disk cache of tool runs. Hits refresh the modification time, and the
+    least recently used entries are evicted once the cache grows beyond
+    max_size bytes.
+    '''
+    VERSION = 'blasys-tool-cache-1'
+
+    def __init__(self, directory, max_size=1<<30):
+        self.directory = directory
+        self.max_size = max_size
+        self.written = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def key(self, args, inputs, outputs):
+        '''
+        Key of a run, or None if the tool or an input file cannot be read
+        '''
+        h = hashlib.sha256(self.VERSION.encode())
+        tool = shutil.which(args[0])
+        if tool is None:
+            return None
+        stat = os.stat(tool)
+        h.update(repr((os.path.basename(tool), stat.st_size, stat.st_mtime)).encode())
+
+        # Longest paths first, so that no path is replaced inside another
+        paths = [(p, '<in{}>'.format(i)) for i, p in enumerate(inputs)] + [(p, '<out{}>'.format(i)) for i, p in enumerate(outputs)]
+        paths.sort(key=lambda p: -len(p[0]))
+        for arg in args[1:]:
+            for path, name in paths:
+                arg = arg.replace(path, name)
+            h.update(arg.encode() + b'\0')
+
+        for path in inputs:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            for other, name in paths:
+                data = data.replace(other.encode(), name.encode())
+            h.update(hashlib.sha256(data).digest())
+        return h.hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+            self.written += f.tell()
+        os.replace(tmp_path, path)
+        # Walking the cache costs more than a tool run, evict now and then
+        if self.written > self.max_size // 16:
+            self.written = 0
+            evict(self.directory, self.max_size)
+
+
+    def purge(self):
+        '''
+        Remove every entry
+        '''
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+
+_cache = None
+
+
+def configure(directory, max_size=1<<30, purge=False):
+    '''
+    Turn the cache on for this process and the pool workers it forks, or
+    off if directory is None
+    '''
+    global _cache
+    _cache = None if directory is None else ToolCache(directory, max_size)
+    if purge and _cache is not None:
+        _cache.purge()
+
+
+def _emit(data, stream):
+    if stream is None:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+    elif stream is not subprocess.DEVNULL:
+        stream.flush()
+        os.write(stream.fileno(), data)
+
+
+def call(args, inputs=(), outputs=(), stdout=None, stderr=None):
+    '''
+    subprocess.call(args) memoized on the contents of the files in inputs.
+    outputs are the files the tool writes, restored on a hit. stdout is
+    None, DEVNULL or a file, and stderr None or STDOUT.
+    '''
+    key = None if _cache is None else _cache.key(args, inputs, outputs)
+    if key is None:
+        return subprocess.call(args, stdout=stdout, stderr=stderr)
+
+    entry = _cache.get(key)
+    if entry is not None:
+        for path, data in zip(outputs, entry['outputs']):
+            if data is not None:
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        _emit(entry['stdout'], stdout)
+        return entry['returncode']
+
+    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=stderr)
+    _emit(proc.stdout, stdout)
+    if proc.returncode == 0:
+        data = []
+        for path in outputs:
+            try:
+                with open(path, 'rb') as f:
+                    data.append(f.read())
+            except OSError:
+                data.append(None)
+        _cache.put(key, {'returncode': proc.returncode, 'stdout': proc.stdout, 'outputs': data})
+    return proc.returncode
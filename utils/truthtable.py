@@ -0,0 +1,213 @@
+import os
+import atexit
+import numpy as np
+from multiprocessing import shared_memory
+
+# Truth tables are kept either as text, one row of 0/1 characters per test
+# vector as printed by vvp (spaces allowed), or in a packed binary container:
+#
+#   bytes  0-7   magic b'BLASYSTT'
+#   bytes  8-11  format version (uint32, little endian)
+#   bytes 12-15  bit order, 0 = column 0 is the MSB of the first byte
+#   bytes 16-23  number of rows (uint64)
+#   bytes 24-31  number of columns (uint64)
+#
+# followed by the rows, each packed into ceil(cols / 8) bytes. Column 0 is the
+# first character of the text row. Both layouts are read through np.memmap,
+# so any range of rows can be read without loading the whole file.
+
+FORMATS = ['text', 'binary']
+
+MAGIC = b'BLASYSTT'
+VERSION = 1
+HEADER_SIZE = 32
+_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('bitorder', '<u4'), ('rows', '<u8'), ('cols', '<u8')])
+
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TruthTable():
+    '''
+    Read-only view of a truth table file of either format
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.binary = is_binary(path)
+
+        if self.binary:
+            header = np.fromfile(path, dtype=_HEADER, count=1)[0]
+            if header['version'] != VERSION or header['bitorder'] != 0:
+                raise ValueError('Unsupported truth table {}'.format(path))
+            self.rows = int(header['rows'])
+            self.cols = int(header['cols'])
+            stride = (self.cols + 7) // 8
+            if self.rows == 0:
+                self.data = np.zeros((0, stride), dtype=np.uint8)
+            else:
+                self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=(self.rows, stride))
+            return
+
+        size = os.path.getsize(path)
+        if size == 0:
+            self.rows, self.cols = 0, 0
+            self.data = np.zeros((0, 1), dtype=np.uint8)
+            self.columns = np.zeros(0, dtype=np.int64)
+            return
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        first = bytes(data[:min(size, 1 << 16)])
+        width = first.find(b'\n') + 1
+        if width > 0 and size % width == 0 and data[width-1::width].tobytes() == b'\n' * (size // width):
+            # Fixed-width rows, as written by vvp and write_truth
+            self.data = data.reshape(-1, width)
+            line = first[:width-1]
+        else:
+            # Ragged file: keep the rows that hold values
+            with open(path, 'rb') as f:
+                lines = [l.rstrip() for l in f.read().split(b'\n') if l.strip() != b'']
+            width = max(len(l) for l in lines)
+            self.data = np.frombuffer(b''.join(l.ljust(width) for l in lines), dtype=np.uint8).reshape(-1, width)
+            line = lines[0]
+        # Positions of the value characters within a row
+        self.columns = np.array([i for i, c in enumerate(line) if c not in b' \r\t'], dtype=np.int64)
+        self.rows = self.data.shape[0]
+        self.cols = len(self.columns)
+
+    @property
+    def shape(self):
+        return (self.rows, self.cols)
+
+    def read(self, start=0, stop=None):
+        '''
+        Rows start..stop as a (rows, cols) uint8 0/1 matrix
+        '''
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        if self.binary:
+            return np.unpackbits(self.data[start:stop], axis=1)[:, :self.cols]
+        return (self.data[start:stop][:, self.columns] == ord('1')).astype(np.uint8)
+
+    def chunks(self, size=1<<16):
+        for start in range(0, self.rows, size):
+            yield self.read(start, start + size)
+
+
+class SharedTruthTable(TruthTable):
+    '''
+    Truth table loaded once into shared memory, rows packed as in the
+    binary format. It pickles as the name of the memory block, so pool
+    workers attach to it without copying or reading the file, once per
+    process (attach_truth). The block is freed by release() or when the
+    creating process exits.
+    '''
+    def __init__(self, path):
+        table = TruthTable(path)
+        self.path = path
+        self.binary = True
+        self.rows, self.cols = table.shape
+        stride = (self.cols + 7) // 8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.rows * stride))
+        self.owner = True
+        self.data = np.ndarray((self.rows, stride), dtype=np.uint8, buffer=self.shm.buf)
+        for start in range(0, self.rows, 1 << 16):
+            self.data[start:start + (1 << 16)] = np.packbits(table.read(start, start + (1 << 16)), axis=1)
+        atexit.register(self.release)
+
+    def state(self):
+        return self.path, self.shm.name, self.rows, self.cols
+
+    def __reduce__(self):
+        return attach_truth, (self.state(),)
+
+    def release(self):
+        if self.shm is None:
+            return
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+_attached = {}
+
+
+def attach_truth(state):
+    '''
+    SharedTruthTable of the block named in state, attached once per process.
+    Also the initializer of the pools of the greedy search.
+    '''
+    path, name, rows, cols = state
+    if name not in _attached:
+        table = SharedTruthTable.__new__(SharedTruthTable)
+        table.path, table.rows, table.cols = path, rows, cols
+        table.binary = True
+        table.shm = shared_memory.SharedMemory(name=name)
+        table.owner = False
+        table.data = np.ndarray((rows, (cols + 7) // 8), dtype=np.uint8, buffer=table.shm.buf)
+        _attached[name] = table
+    return _attached[name]
+
+
+def open_truth(truth):
+    '''
+    TruthTable of a path, or the table itself if already loaded
+    '''
+    return truth if isinstance(truth, TruthTable) else TruthTable(truth)
+
+
+def load_truth(path):
+    '''
+    Whole truth table of either format as a uint8 matrix
+    '''
+    return TruthTable(path).read()
+
+
+def write_truth(matrix, path, fmt='text'):
+    '''
+    Write a 0/1 matrix. Text rows are written as vvp prints them with %b.
+    The file is replaced atomically.
+    '''
+    matrix = np.asarray(matrix, dtype=np.uint8)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if fmt == 'binary':
+        header = np.zeros(1, dtype=_HEADER)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['rows'], header['cols'] = matrix.shape
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(np.packbits(matrix, axis=1).tobytes())
+    elif fmt == 'text':
+        lines = np.empty((matrix.shape[0], matrix.shape[1] + 1), dtype=np.uint8)
+        lines[:, :-1] = matrix + ord('0')
+        lines[:, -1] = ord('\n')
+        with open(tmp_path, 'wb') as f:
+            f.write(lines.tobytes())
+    else:
+        raise ValueError('Unknown truth table format {}'.format(fmt))
+    os.replace(tmp_path, path)
+
+
+def read_stream(stream, block_size=1<<20):
+    '''
+    Rows printed by vvp with %b on a binary stream such as a pipe, yielded
+    as uint8 0/1 matrices of the rows of each block read. Lines holding
+    anything but 0/1/x/z are skipped.
+    '''
+    rest = b''
+    while True:
+        block = stream.read(block_size)
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop() if block else b''
+        rows = [l.strip().replace(b' ', b'') for l in lines]
+        rows = [r for r in rows if r != b'' and r.translate(None, b'01xzXZ') == b'']
+        if rows:
+            if any(len(r) != len(rows[0]) for r in rows):
+                raise ValueError('Rows of different widths in simulation output')
+            chars = np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(len(rows), -1)
+            yield (chars == ord('1')).astype(np.uint8)
+        if not block:
+            break
@@ -5,7 +5,16 @@ import numpy as np
 import shutil
 import subprocess
 import time
-from .ASSO.BMF import BMF
+import random
+import itertools
+from .ASSO.BMF import factorize, BMF_all_degrees, load_factorization
+from .ASSO.utils import get_matrix
+from .simulator import simulate_testbench, testbench_netlist, read_testbench, read_modules, TableBox, SimulationError, LoopError
+from .truthtable import write_truth, read_stream
+from . import metric
+from .create_tb import write_stimulus
+from .yosys import session as yosys_session, YosysError
+from . import toolcache
 
 class CombinationalLoop(Exception):
     pass
@@ -14,113 +23,446 @@ class NoValidDesign(Exception):
     pass
 
 
-def evaluate_design(k_stream, worker, filename, display=True):
-    if display:
-        print('Evaluating Design:', k_stream)
+def candidate_verilog(k_stream, worker):
+    '''
+    Verilog files of a candidate: the top level and every partition at its
+    degree, approximating partitions not approximated before
+    '''
     verilog_list = [os.path.join(worker.output, 'partition', worker.modulename + '.v')]
 
     # Parse each subcircuit
     for i, modulename in enumerate(worker.modulenames):
-        approx_degree = k_stream[i]
+        verilog_list.append(variant_verilog(worker, i, k_stream[i]))
+    return verilog_list
+
+
+def variant_verilog(worker, i, approx_degree):
+    '''
+    Verilog file of partition i at a degree
+    '''
+    modulename = worker.modulenames[i]
+
+    # If subcircuit is not approximated
+    if approx_degree == worker.output_list[i]:
+        return os.path.join(worker.output, 'partition', modulename + '.v')
+
+    part_verilog = os.path.join(worker.output, 'bmf_partition', modulename, modulename + '_approx_k=' + str(approx_degree) + '.v')
+    # If has not been approximated before
+    if not os.path.exists(part_verilog):
+        print('----- Approximating part ' + str(i) + ' to degree ' + str(approx_degree))
+
+        directory = os.path.join(worker.output, 'bmf_partition', modulename, modulename)
+        approximate(directory, approx_degree, worker, i)
+    return part_verilog
+
+
+def evaluate_design(k_stream, worker, filename, display=True, error_first=None):
+    if display:
+        print('Evaluating Design:', k_stream)
+    verilog_list = candidate_verilog(k_stream, worker)
+
+    # Error first: designs already above the error bound are not synthesized
+    if error_first is None:
+        error_first = worker.error_first and worker.error_bound is not None
+    output_syn = os.path.join(worker.output, 'tmp', filename)
+    if error_first:
+        try:
+            err = design_error(k_stream, worker, filename, verilog_list)
+        except CombinationalLoop:
+            return None
+        if err > worker.error_bound:
+            print('Simulation error: {:.6f}\tRejected before synthesis'.format(err))
+            return err, np.inf, float('nan'), float('nan')
 
-        # If subcircuit is not approximated
-        if approx_degree == worker.output_list[i]:
-            part_verilog = os.path.join(worker.output, 'partition', modulename + '.v')
-            verilog_list.append(part_verilog)
-            continue
-        
-        part_verilog = os.path.join(worker.output, 'bmf_partition', modulename, modulename + '_approx_k=' + str(approx_degree) + '.v')
-        # If has not been approximated before
-        if not os.path.exists(part_verilog):
-            print('----- Approximating part ' + str(i) + ' to degree ' + str(approx_degree))
-
-            directory = os.path.join(worker.output, 'bmf_partition', modulename, modulename)
-            approximate(directory, approx_degree, worker, i)
-        
-        verilog_list.append(part_verilog)
-    
     # Synthesize and estimate chip area
     try:
-        output_syn = os.path.join(worker.output, 'tmp', filename)
-        area  = synth_design(' '.join(verilog_list), output_syn, worker.library, worker.script, worker.path['yosys'])
+        area = synth_verilog(verilog_list, output_syn, worker, worker.hierarchical)
+        if not error_first:
+            err = design_error(k_stream, worker, filename, verilog_list, output_syn+'.v')
     except CombinationalLoop:
         return None
 
-    # QoR estimation
-    truth_dir = os.path.join(worker.output, 'truthtable', filename+'.truth')
-    subprocess.call([worker.path['iverilog'], '-o', truth_dir[:-5]+'iv'] + verilog_list + [worker.testbench])
-    with open(truth_dir, 'w') as f:
-        subprocess.call([worker.path['vvp'], truth_dir[:-5]+'iv'], stdout=f)
-    os.remove(truth_dir[:-5] + 'iv')
-
-    ground_truth = os.path.join(worker.output, worker.modulename + '.truth')
-    err = worker.metric(ground_truth, truth_dir)
-    
+    delay, power = design_timing(worker, filename)
     if worker.sta:
-        # Estimate time and power
-        sta_script = os.path.join(worker.output, 'tmp', filename+'_sta.script')
-        sta_output = os.path.join(worker.output, 'tmp', filename+'_sta.out')
-        delay = get_delay(worker.path['OpenSTA'], sta_script, worker.library, output_syn+'_syn.v', worker.modulename, sta_output)
-        power = get_power(worker.path['OpenSTA'], sta_script, worker.library, output_syn+'_syn.v', worker.modulename, sta_output, worker.delay)
-
         print('Simulation error: {:.6f}\tCircuit area: {:.6f}\tCircuit delay: {:.6f}\tPower consumption: {:.6f}'.format(err, area, delay, power))
-
-        os.remove(sta_script)
-        os.remove(sta_output)
     else:
-        delay = float('nan')
-        power = float('nan')
         print('Simulation error: {:.6f}\tCircuit area: {:.6f}'.format(err, area))
 
 
     return err, area, delay, power
 
 
-def synth_design(input_file, output_file, lib_file, script, yosys):
+def synth_verilog(verilog_list, output_syn, worker, hierarchical=False):
+    if hierarchical and worker.library is not None:
+        return synth_hierarchical(verilog_list, output_syn, worker)
+    if worker.yosys_session:
+        return synth_candidate(verilog_list, output_syn, worker.library, worker.script, worker.path['yosys'])
+    return synth_design(' '.join(verilog_list), output_syn, worker.library, worker.script, worker.path['yosys'])
 
-    if lib_file is not None:
-        yosys_command = 'read_verilog ' + input_file + '; ' + 'synth -flatten; opt; opt_clean -purge;  opt; opt_clean -purge; write_verilog -noattr ' +output_file + '.v; abc -liberty '+lib_file + ' -script ' + script + '; stat -liberty '+lib_file + '; write_verilog -noattr ' +output_file + '_syn.v;\n '
-        area = 0
-        #line=subprocess.call(yosys+" -p \'"+ yosys_command+"\' > "+ output_file+".log", shell=True)
-        with open(output_file+'.log', 'w') as f:
-            line = subprocess.call([yosys, '-p', yosys_command], stdout=f, stderr=subprocess.STDOUT)
-        with open(output_file+".log", 'r') as file_handle:
-            for line in file_handle:
-                # Combinational loop
-                if 'Warning: found logic loop' in line:
-                    os.remove(output_file+'.log')
-                    raise CombinationalLoop()
 
-                # Find chip area and return
-                if 'Chip area' in line:
-                    area = line.split()[-1]
-                    break
+def design_timing(worker, filename):
+    '''
+    Delay and power of the synthesized netlist of a candidate
+    '''
+    if not worker.sta:
+        return float('nan'), float('nan')
 
-    else:
-        yosys_command = 'read_verilog ' + input_file + '; ' + 'synth -flatten; opt; opt_clean -purge; opt; opt_clean -purge; write_verilog -noattr ' +output_file + '.v; abc -g NAND -script ' + script + '; write_verilog -noattr ' +output_file + '_syn.v;\n '
-        area = 0
-        #line=subprocess.call(yosys+" -p \'"+ yosys_command+"\' > "+ output_file+".log", shell=True)
-        with open(output_file+'.log', 'w') as f:
-            line = subprocess.call([yosys, '-p', yosys_command], stdout=f, stderr=subprocess.STDOUT)
-        with open(output_file+".log", 'r') as file_handle:
-            return_list = []
-            for line in file_handle:
-                # Combinational loop
-                if 'Warning: found logic loop' in line:
-                    os.remove(output_file+'.log')
-                    raise CombinationalLoop()
-
-                # Find num of NAND cells
-                if 'ABC RESULTS:' in line and 'NAND cells:' in line:
-                    return_list.append(line.split()[-1])
-            if len(return_list) == 0:
-                area = 0
+    # Estimate time and power
+    output_syn = os.path.join(worker.output, 'tmp', filename)
+    sta_script = os.path.join(worker.output, 'tmp', filename+'_sta.script')
+    sta_output = os.path.join(worker.output, 'tmp', filename+'_sta.out')
+    delay = get_delay(worker.path['OpenSTA'], sta_script, worker.library, output_syn+'_syn.v', worker.modulename, sta_output)
+    power = get_power(worker.path['OpenSTA'], sta_script, worker.library, output_syn+'_syn.v', worker.modulename, sta_output, worker.delay)
+
+    os.remove(sta_script)
+    os.remove(sta_output)
+    return delay, power
+
+
+def synthesize_design(k_stream, worker, filename):
+    '''
+    Area, delay and power of a candidate whose error is already known.
+    Returns None on a combinational loop.
+    '''
+    try:
+        area = synth_verilog(candidate_verilog(k_stream, worker), os.path.join(worker.output, 'tmp', filename), worker, worker.hierarchical)
+    except CombinationalLoop:
+        return None
+    delay, power = design_timing(worker, filename)
+    return area, delay, power
+
+
+def variant_area(worker, i, k):
+    '''
+    Area of partition i at degree k synthesized alone, stored next to its
+    Verilog so that every process synthesizes each variant once
+    '''
+    verilog = variant_verilog(worker, i, k)
+    area_file = verilog[:-2] + '.area'
+    try:
+        with open(area_file) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        pass
+
+    output_syn = os.path.join(worker.output, 'tmp', '{}_variant_k={}'.format(worker.modulenames[i], k))
+    area = synth_verilog([verilog], output_syn, worker)
+    tmp_file = '{}.{}.tmp'.format(area_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(repr(area))
+    os.replace(tmp_file, area_file)
+    return area
+
+
+def evaluate_surrogate(k_stream, worker, filename, display=True):
+    '''
+    Error of a candidate, and its area estimated as the sum of the areas
+    of its partitions synthesized alone plus the top-level glue
+    '''
+    if display:
+        print('Evaluating Design:', k_stream)
+    try:
+        err = design_error(k_stream, worker, filename, candidate_verilog(k_stream, worker))
+        area = worker.glue_area + sum(variant_area(worker, i, k) for i, k in enumerate(k_stream))
+    except CombinationalLoop:
+        return None
+    print('Simulation error: {:.6f}\tSurrogate area: {:.6f}'.format(err, area))
+    return err, area, float('nan'), float('nan')
+
+
+def design_error(k_stream, worker, filename, verilog_list, netlist=None):
+    '''
+    Error of a candidate made of the Verilog files in verilog_list. The
+    NumPy simulator runs on netlist, the flattened design written by
+    synth_design, or on the files themselves if it is None.
+    '''
+    ground_truth = os.path.join(worker.output, worker.modulename + '.truth')
+    # Built-in metrics read the ground truth the worker keeps in shared memory
+    baseline = ground_truth if worker.ground_truth is None else worker.ground_truth
+    # Monte Carlo estimation stops simulating designs clearly above the error
+    # bound. The first vectors of exhaustive testbenches are no random sample.
+    estimate = worker.estimate and worker.error_bound is not None and worker.metric_name in metric.SAMPLES and random_order(worker.testbench)
+    outputs = None
+    if worker.simulator in ('numpy', 'lut'):
+        try:
+            # Netlist flattened once and simulated on every batch
+            if worker.simulator == 'lut':
+                circuit = lut_netlist(k_stream, worker)
+            else:
+                if netlist is None:
+                    modules = dict()
+                    for verilog in verilog_list:
+                        modules.update(read_modules(verilog, cache=True))
+                else:
+                    # Flattened netlist yosys wrote before technology mapping
+                    modules = read_modules(netlist)
+                circuit = testbench_netlist(modules, worker.testbench)
+            simulate = lambda vectors=None: simulate_testbench(circuit, worker.testbench, vectors=vectors)
+            if estimate:
+                outputs = batches(simulate, read_testbench(worker.testbench)[3].shape[0])
+                # First batch here, so that failures fall back to iverilog
+                outputs = itertools.chain([next(outputs)], outputs)
             else:
-                area = return_list[-1]
+                outputs = [simulate()]
+        except LoopError:
+            raise CombinationalLoop()
+        except SimulationError as e:
+            print('[Warning] {} simulation failed ({}), falling back to iverilog.'.format(worker.simulator, e))
+    iv_file = os.path.join(worker.output, 'truthtable', filename+'.iv')
+    if outputs is None:
+        toolcache.call([worker.path['iverilog'], '-o', iv_file] + verilog_list + [worker.testbench], verilog_list + [worker.testbench], [iv_file])
+        outputs = vvp_rows(worker.path['vvp'], iv_file, 1<<16 if estimate else 1<<20)
+
+    if estimate:
+        err = metric.estimate(worker.metric_name, baseline, outputs, worker.error_bound, worker.confidence)
+    elif worker.metric_name in metric.DISTANCE_OF:
+        # Fold the outputs into every metric without writing a truth table,
+        # and log them all
+        names, values = metric.distance_chunks(baseline, outputs)
+        err = values[names.index(metric.DISTANCE_OF[worker.metric_name])]
+        with open(os.path.join(worker.output, 'log', 'metrics.csv'), 'a') as f:
+            f.write(filename + ''.join(',{:.6e}'.format(v) for v in values) + '\n')
+    else:
+        # Other metrics read the truth table from a file
+        truth_dir = os.path.join(worker.output, 'truthtable', filename+'.truth')
+        write_truth(stack_rows(outputs), truth_dir, worker.truth_format)
+        err = worker.metric(ground_truth, truth_dir)
+    if hasattr(outputs, 'close'):
+        # Stops vvp if the metric did not read all rows
+        outputs.close()
+    if os.path.exists(iv_file):
+        os.remove(iv_file)
+    return err
+
+
+def vvp_rows(vvp, iv, block_size=1<<20):
+    '''
+    Output rows of a compiled testbench, read from the vvp pipe in chunks
+    of block_size bytes
+    '''
+    proc = subprocess.Popen([vvp, iv], stdout=subprocess.PIPE)
+    try:
+        yield from read_stream(proc.stdout, block_size)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def random_order(testbench):
+    '''
+    Whether the vectors of a testbench are in random order, that is not in
+    increasing order as exhaustive and sampled testbenches are
+    '''
+    try:
+        # MSB first
+        vectors = read_testbench(testbench)[3][:, ::-1]
+    except (SimulationError, OSError):
+        return False
+    if vectors.shape[0] < 2:
+        return False
+    changed = vectors[1:] != vectors[:-1]
+    first = changed.argmax(axis=1)
+    rows = np.arange(first.shape[0])
+    increasing = ~changed.any(axis=1) | (vectors[1:][rows, first] > vectors[:-1][rows, first])
+    return not increasing.all()
+
+
+def batches(simulate, num_vectors, size=1024):
+    '''
+    Outputs of simulate(vectors) over slices of the test vectors that double
+    in size
+    '''
+    start = 0
+    while start < num_vectors:
+        yield simulate(slice(start, start + size))
+        start += size
+        size *= 2
+
+
+def stack_rows(chunks):
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return np.vstack(chunks)
+
+
+def simulate_truth(vvp, iv, path, fmt):
+    '''
+    Run a compiled testbench and write its truth table in format fmt,
+    reading the rows from the vvp pipe
+    '''
+    write_truth(stack_rows(vvp_rows(vvp, iv)), path, fmt)
+
+
+_boxes = {}
+
+
+def table_box(verilog, modulename, table):
+    '''
+    TableBox of a partition, kept for the life of the process
+    '''
+    key = (verilog, table)
+    mtime = (os.path.getmtime(verilog), os.path.getmtime(table))
+    if key not in _boxes or _boxes[key][0] != mtime:
+        module = read_modules(verilog, cache=True)[modulename]
+        _boxes[key] = (mtime, TableBox(module, get_matrix(table)))
+    return _boxes[key][1]
+
+
+def lut_outputs(k_stream, worker, vectors=None):
+    '''
+    Outputs of a candidate on the testbench vectors, vectors optionally
+    slicing them
+    '''
+    return simulate_testbench(lut_netlist(k_stream, worker), worker.testbench, vectors=vectors)
+
+
+def lut_netlist(k_stream, worker):
+    '''
+    Netlist of a candidate for the testbench: the top-level netlist with
+    every partition looked up in its truth table (.truth, or .truth_wh_k
+    once approximated). Partitions factorized on sampled rows have no full
+    table and are simulated from their Verilog.
+    '''
+    modules = dict(read_modules(os.path.join(worker.output, 'partition', worker.modulename + '.v'), cache=True))
+    boxes = {}
+    for i, modulename in enumerate(worker.modulenames):
+        part_verilog = os.path.join(worker.output, 'partition', modulename + '.v')
+        part_dir = os.path.join(worker.output, 'bmf_partition', modulename, modulename)
+        if k_stream[i] == worker.output_list[i]:
+            table = part_dir + '.truth'
+            verilog = part_verilog
+        else:
+            table = part_dir + '.truth_wh_' + str(k_stream[i])
+            verilog = part_dir + '_approx_k=' + str(k_stream[i]) + '.v'
+
+        if worker.input_list[i] > 16:
+            modules.update(read_modules(verilog, cache=True))
+        else:
+            boxes[modulename] = table_box(part_verilog, modulename, table)
+
+    return testbench_netlist(modules, worker.testbench, boxes)
 
-    os.remove(output_file+'.log')
+
+def synth_commands(output_file, lib_file, script):
+    '''
+    Yosys commands that synthesize the current design, write the netlists
+    and report its area
+    '''
+    if lib_file is not None:
+        return ['synth -flatten', 'opt', 'opt_clean -purge', 'opt', 'opt_clean -purge', 'write_verilog -noattr ' +output_file + '.v', 'abc -liberty '+lib_file + ' -script ' + script, 'stat -liberty '+lib_file, 'write_verilog -noattr ' +output_file + '_syn.v']
+    else:
+        return ['synth -flatten', 'opt', 'opt_clean -purge', 'opt', 'opt_clean -purge', 'write_verilog -noattr ' +output_file + '.v', 'abc -g NAND -script ' + script, 'write_verilog -noattr ' +output_file + '_syn.v']
+
+
+def synth_area(lines, lib_file):
+    '''
+    Chip area, or number of NAND cells without liberty, from yosys output
+    '''
+    area = 0
+    for line in lines:
+        # Combinational loop
+        if 'Warning: found logic loop' in line:
+            raise CombinationalLoop()
+
+        if lib_file is not None:
+            # Find chip area and return
+            if 'Chip area' in line:
+                return float(line.split()[-1])
+        elif 'ABC RESULTS:' in line and 'NAND cells:' in line:
+            # Find num of NAND cells
+            area = line.split()[-1]
     return float(area)
 
+
+def synth_design(input_file, output_file, lib_file, script, yosys):
+
+    yosys_command = 'read_verilog ' + input_file + '; ' + '; '.join(synth_commands(output_file, lib_file, script)) + ';\n '
+    #line=subprocess.call(yosys+" -p \'"+ yosys_command+"\' > "+ output_file+".log", shell=True)
+    with open(output_file+'.log', 'w') as f:
+        inputs = input_file.split() + [script] + ([] if lib_file is None else [lib_file])
+        toolcache.call([yosys, '-p', yosys_command], inputs, [output_file + '.v', output_file + '_syn.v'], stdout=f, stderr=subprocess.STDOUT)
+    try:
+        with open(output_file+".log", 'r') as file_handle:
+            return synth_area(file_handle, lib_file)
+    finally:
+        os.remove(output_file+'.log')
+
+
+def synth_candidate(verilog_list, output_file, lib_file, script, yosys):
+    '''
+    synth_design on the persistent yosys of the process, falling back to a
+    new yosys process if it fails
+    '''
+    try:
+        lines = yosys_session(yosys).synth(verilog_list, synth_commands(output_file, lib_file, script))
+    except YosysError as e:
+        print('[Warning] Persistent yosys failed ({}), running yosys again.'.format(e))
+        return synth_design(' '.join(verilog_list), output_file, lib_file, script, yosys)
+    return synth_area(lines, lib_file)
+
+
+def run_yosys(commands, log_file, worker, inputs=(), outputs=()):
+    '''
+    Run yosys commands, on the persistent yosys of the process if enabled,
+    and return the lines they printed. inputs and outputs are the files
+    they read and write, for the tool cache.
+    '''
+    if worker.yosys_session:
+        try:
+            return yosys_session(worker.path['yosys']).run(['design -reset'] + commands)
+        except YosysError as e:
+            print('[Warning] Persistent yosys failed ({}), running yosys again.'.format(e))
+    with open(log_file, 'w') as f:
+        toolcache.call([worker.path['yosys'], '-p', '; '.join(commands)], inputs, outputs, stdout=f, stderr=subprocess.STDOUT)
+    try:
+        with open(log_file) as f:
+            return f.readlines()
+    finally:
+        os.remove(log_file)
+
+
+def map_variant(worker, verilog, modulename):
+    '''
+    Netlist of a partition variant mapped to cells alone, stored next to
+    its Verilog so that every process maps each variant once
+    '''
+    mapped = verilog[:-2] + '_mapped.v'
+    if os.path.exists(mapped):
+        return mapped
+
+    tmp_file = '{}.{}.tmp'.format(mapped, os.getpid())
+    commands = ['read_verilog ' + verilog, 'synth -flatten -top ' + modulename, 'opt', 'opt_clean -purge', 'abc -liberty ' + worker.library + ' -script ' + worker.script, 'opt_clean -purge', 'write_verilog -noattr ' + tmp_file]
+    lines = run_yosys(commands, tmp_file + '.log', worker, [verilog, worker.library, worker.script], [tmp_file])
+    for line in lines:
+        if 'Warning: found logic loop' in line:
+            raise CombinationalLoop()
+    if not os.path.exists(tmp_file):
+        raise RuntimeError('yosys could not map ' + verilog)
+    os.replace(tmp_file, mapped)
+    return mapped
+
+
+def synth_hierarchical(verilog_list, output_file, worker):
+    '''
+    Synthesize a candidate by linking the cached mapped netlists of its
+    partitions under the top level, so that only the top-level glue is
+    mapped again. output_file.v holds the candidate RTL, for simulation.
+    '''
+    mapped = [map_variant(worker, verilog, modulename) for verilog, modulename in zip(verilog_list[1:], worker.modulenames)]
+    with open(output_file + '.v', 'w') as f:
+        for verilog in verilog_list:
+            with open(verilog) as src:
+                f.write(src.read() + '\n')
+
+    commands = ['read_liberty -lib ' + worker.library, 'read_verilog ' + ' '.join([verilog_list[0]] + mapped), 'hierarchy -top ' + worker.modulename, 'proc', 'flatten', 'techmap', 'opt_clean -purge']
+    # Constant propagation and dead cell removal across partition boundaries
+    if worker.boundary_opt:
+        commands += ['opt -full', 'opt_clean -purge']
+    commands += ['abc -liberty ' + worker.library + ' -script ' + worker.script, 'opt_clean -purge', 'stat -liberty ' + worker.library, 'write_verilog -noattr ' + output_file + '_syn.v']
+    lines = run_yosys(commands, output_file + '.log', worker, [worker.library, verilog_list[0], worker.script] + mapped, [output_file + '_syn.v'])
+    return synth_area(lines, worker.library)
+
 def inpout(fname):
     with open(fname) as file:
         line = file.readline()
@@ -150,7 +492,29 @@ def inpout(fname):
     return n_inputs, n_outputs
 
 
-def gen_truth(fname, modulename):
+def sample_inputs(n, num, mode='random'):
+    '''
+    Pick num distinct input vectors of an n-input circuit, in increasing order.
+    random:     uniform sample without replacement.
+    stratified: one uniform vector in each of num equal slices of the input space.
+    '''
+    if 2 ** n <= num:
+        return list(range(2 ** n))
+    if mode == 'stratified':
+        return [random.randrange(s * 2**n // num, (s+1) * 2**n // num) for s in range(num)]
+    # random.sample cannot take a range of 2**63 vectors
+    vectors = set()
+    while len(vectors) < num:
+        vectors.add(random.getrandbits(n))
+    return sorted(vectors)
+
+
+def read_samples(fname):
+    with open(fname) as f:
+        return [int(line, 2) for line in f if line.strip() != '']
+
+
+def gen_truth(fname, modulename, num_sample=None, sample_mode='random', max_inputs=16):
     with open(fname+'.v') as file:
         f=open(fname+'_tb.v', "w+")
         line = file.readline()
@@ -177,9 +541,18 @@ def gen_truth(fname, modulename):
                         out=0
             line=file.readline()
         file.close()
-    if n_inputs > 16:   
-        print('BLASYS cannot handle more than 16 inputs per partition; reduce parition sizes')
-        exit(-1)
+    if n_inputs > 16:
+        if num_sample is None or n_inputs > max_inputs:
+            print('BLASYS cannot handle more than {} inputs per partition; reduce parition sizes'.format(max(16, max_inputs)))
+            exit(-1)
+        # Simulate a sample of the input space only, for partitions of up to
+        # max_inputs inputs. The vectors are kept so that W can later be
+        # synthesized from the sampled rows.
+        vectors = sample_inputs(n_inputs, num_sample, sample_mode)
+        vector_file = fname+'.sample'
+    else:
+        vectors = range(2**n_inputs)
+        vector_file = fname+'_tb.vec'
     f.write("module "+modulename+"_tb;\n")
     f.write('reg ['+str(n_inputs-1)+':0] pi;\n')
     f.write('wire ['+str(n_outputs-1)+':0] po;\n')
@@ -227,20 +600,7 @@ def gen_truth(fname, modulename):
                         out=0
             line=file.readline()
         file.close()
-    f.write("initial\n")
-    f.write("begin\n")
-    j=0
-    while j < 2**n_inputs:
-        f.write('# 1  pi='+str(n_inputs)+'\'b')
-        str1=bin(j).replace("0b", "")
-        str2="0"*(n_inputs-len(str1))
-        n=str2+str1
-        f.write(n)
-        f.write(';\n')
-        f.write("#1 $display(\"%b\", po);\n")
-        j+=1
-    f.write("end\n")
-    f.write("endmodule\n")
+    write_stimulus(f, n_inputs, vectors, vector_file)
     f.close()
     return n_inputs, n_outputs
 
@@ -264,35 +624,224 @@ def v2w(signal,  n):
     return s
 
 
-def create_w(n, k, W, f1, modulename, formula_file, abc):    
+def create_w(n, k, W, f1, modulename, formula_file, abc, memo=None):    
     f1.write('module '+modulename+'_w'+str(k)+'('+v2w('in', n)+', '+ v2w('k', k)+');\n')
     f1.write('input '+v2w('in', n)+';\n')
     f1.write('output '+v2w('k', k)+';\n')
 
+    # Column i of W drives k(k-i-1); constant-zero and memoized columns skip ABC
+    formulas = {}
+    names = []
+    truths = []
+    for i in range(k-1, -1, -1):
+        truth = ''.join(map(str, W[::-1, i]))
+        if truth.find('1') == -1:
+            continue
+        formula = memo.get('abc', truth) if memo is not None else None
+        if formula is not None:
+            formulas['k'+str(k-i-1)] = formula
+        else:
+            names.append('k'+str(k-i-1))
+            truths.append(truth)
+
+    wires, synthesized = abc_formulas(n, truths, names, formula_file, abc)
+    formulas.update(synthesized)
+
+    # Only expressions of the inputs alone can be reused
+    if memo is not None:
+        for name, truth in zip(names, truths):
+            if set(re.findall(r'\w+', formulas[name])).isdisjoint(wires):
+                memo.put('abc', truth, formulas[name])
+
+    if len(wires) > 0:
+        f1.write('wire '+', '.join(wires)+';\n')
+    for name in wires:
+        f1.write('assign '+name+' = '+formulas[name])
+
+    for i in range(k-1, -1, -1):
+        name = 'k'+str(k-i-1)
+        f1.write('assign '+name+' = '+formulas.get(name, '0;\n'))
+
+    f1.write('endmodule\n\n')
+
+
+def abc_formulas(n, truths, names, formula_file, abc):
+    '''
+    Synthesize several functions of in0..in(n-1) with a single ABC run.
+    truths are binary truth strings (last row first) and names the signals
+    they drive. Returns the internal wires of the ABC netlist and a dict
+    mapping every wire and name to its expression.
+    '''
+    if len(truths) == 0:
+        return [], {}
+
+    # Private files, pool workers may approximate the same partition
+    prefix = '{}.{}'.format(formula_file[:-2], os.getpid())
+    truth_file = prefix + '.truth'
+    verilog_file = prefix + '.v'
+    with open(truth_file, 'w') as f:
+        f.write('\n'.join(truths) + '\n')
+
+    script = 'read_truth -x -f '+truth_file+';bdd;order;write_verilog '+verilog_file
+    toolcache.call([abc, '-q', script], [truth_file], [verilog_file])
+    with open(verilog_file, 'r') as file_handle:
+        netlist = file_handle.read()
+    os.remove(truth_file)
+    os.remove(verilog_file)
+
+    # ABC declares one input per variable and one output per truth table,
+    # both in order; variable c of the truth table is in(n-c-1)
+    def declared(keyword):
+        decl = re.findall(r'\b' + keyword + r'\b([^;]*);', netlist)
+        return [t for d in decl for t in re.split(r'[\s,]+', d) if t != '']
+
+    rename = {}
+    for c, name in enumerate(declared('input')):
+        rename[name] = 'in'+str(n-c-1)
+    for name, target in zip(declared('output'), names):
+        rename[name] = target
+    wires = []
+    for name in declared('wire'):
+        rename[name] = 'w_'+name
+        wires.append('w_'+name)
+
+    formulas = {}
+    for lhs, rhs in re.findall(r'\bassign\s+(\S+)\s*=\s*([^;]*);', netlist):
+        rhs = re.sub(r"(?<!')\b[A-Za-z_]\w*\b", lambda m: rename.get(m.group(0), m.group(0)), rhs)
+        formulas[rename.get(lhs, lhs)] = ' '.join(rhs.split()) + ';\n'
+
+    return wires, formulas
+
+def sampled_cover(onset, offset):
+    '''
+    Two-level cover of a function known only on sampled rows. onset and
+    offset are boolean (rows, n) input vectors; every other input vector is a
+    don't-care. Each uncovered onset vector is expanded into a cube by
+    dropping literals as long as the cube hits no offset vector.
+    Returns a list of cubes as (care mask, values).
+    '''
+    cubes = []
+    uncovered = np.ones(len(onset), dtype=bool)
+    while uncovered.any():
+        minterm = onset[np.argmax(uncovered)]
+        care = np.ones(onset.shape[1], dtype=bool)
+
+        # Number of cared literals separating each offset vector from the cube
+        differ = offset != minterm
+        count = differ.sum(axis=1)
+
+        # Drop the literals that separate the fewest offset vectors first
+        for t in np.argsort(differ.sum(axis=0), kind='stable'):
+            if not np.any((count == 1) & differ[:, t]):
+                care[t] = False
+                count -= differ[:, t]
+
+        covered = np.all(onset[:, care] == minterm[care], axis=1)
+        uncovered &= ~covered
+        cubes.append((care, minterm))
+
+    return cubes
+
+
+def create_w_sampled(n, k, W, samples, f1, modulename):
+    f1.write('module '+modulename+'_w'+str(k)+'('+v2w('in', n)+', '+ v2w('k', k)+');\n')
+    f1.write('input '+v2w('in', n)+';\n')
+    f1.write('output '+v2w('k', k)+';\n')
+
+    # Bit t of a sampled vector drives input in<t>
+    samples = np.array(samples, dtype=np.uint64)
+    bits = ((samples[:, None] >> np.arange(n, dtype=np.uint64)) & np.uint64(1)).astype(bool)
+
     for i in range(k-1, -1, -1):
         f1.write('assign k'+str(k-i-1)+' = ')
-        
-        truth=""
-        for j in range(2 ** n-1,-1,-1):
-            truth= truth+str(W[j,i])
-#        print(truth)
-        if truth.find('1') != -1:
-            script='read_truth -x '+truth+';bdd;order;write_verilog '+formula_file
-            #os.system(abc+' -q '+'\''+script+'\'')
-            subprocess.call([abc, '-q', script])
-            with open(formula_file, 'r') as file_handle:
-                for line in file_handle:
-                    if 'assign' in line:
-                        formula=line
-            formula=formula.replace('assign F = ', '')
-#            print(formula)
-            for c in range(n):
-                formula=formula.replace(chr(97+c)+ ';', 'in'+str(n-c-1)+';')
-                formula=formula.replace(chr(97+c)+ ' ', 'in'+str(n-c-1)+' ')
-                formula=formula.replace(chr(97+c)+ ')', 'in'+str(n-c-1)+')')
+
+        onset = bits[W[:, i] == 1]
+        offset = bits[W[:, i] == 0]
+        if len(onset) == 0:
+            formula = '0;\n'
+        elif len(offset) == 0:
+            formula = '1;\n'
         else:
-            formula='0;\n'
- #       print(formula)
+            cubes = [[(t, values[t]) for t in range(n) if care[t]] for care, values in sampled_cover(onset, offset)]
+            formula = sop_formula(cubes)
+        f1.write(formula)
+
+    f1.write('endmodule\n\n')
+
+
+def isop(lower, upper, n, memo=None):
+    '''
+    Irredundant sum-of-products of a function between two truth tables
+    (Minato-Morreale). lower and upper are ints whose bit r is the value on
+    input vector r, where bit t of r drives in<t>; lower must imply upper.
+    Returns the cubes as tuples of (t, value) literals and the truth table
+    of the cover.
+    '''
+    if lower == 0:
+        return [], 0
+    full = (1 << (1 << n)) - 1
+    if upper == full:
+        return [()], full
+
+    if memo is None:
+        memo = {}
+    key = (lower, upper, n)
+    if key in memo:
+        return memo[key]
+
+    # Cofactors with respect to the top input in<n-1>
+    half = 1 << (n-1)
+    mask = (1 << half) - 1
+    l0, l1 = lower & mask, lower >> half
+    u0, u1 = upper & mask, upper >> half
+
+    if l0 == l1 and u0 == u1:
+        cubes, cover = isop(l0, u0, n-1, memo)
+        result = cubes, cover | (cover << half)
+    else:
+        c0, r0 = isop(l0 & ~u1, u0, n-1, memo)
+        c1, r1 = isop(l1 & ~u0, u1, n-1, memo)
+        cs, rs = isop((l0 & ~r0) | (l1 & ~r1), u0 & u1, n-1, memo)
+        cubes = [c + ((n-1, 0),) for c in c0] + [c + ((n-1, 1),) for c in c1] + cs
+        result = cubes, (r0 | rs) | ((r1 | rs) << half)
+
+    memo[key] = result
+    return result
+
+
+def sop_formula(cubes):
+    '''
+    Verilog expression of a list of cubes of (t, value) literals
+    '''
+    if len(cubes) == 0:
+        return '0;\n'
+    terms = []
+    for cube in cubes:
+        literals = [('' if v else '~') + 'in' + str(t) for t, v in sorted(cube, reverse=True)]
+        if len(literals) == 0:
+            return '1;\n'
+        terms.append('(' + ' & '.join(literals) + ')')
+    return ' | '.join(terms) + ';\n'
+
+
+def create_w_isop(n, k, W, f1, modulename, memo=None):
+    f1.write('module '+modulename+'_w'+str(k)+'('+v2w('in', n)+', '+ v2w('k', k)+');\n')
+    f1.write('input '+v2w('in', n)+';\n')
+    f1.write('output '+v2w('k', k)+';\n')
+
+    # Columns as ints, bit r is row r
+    cubes_memo = {}
+    for i in range(k-1, -1, -1):
+        f1.write('assign k'+str(k-i-1)+' = ')
+        truth = int.from_bytes(np.packbits(W[:, i], bitorder='little').tobytes(), 'little')
+        signature = '{}:{:x}'.format(n, truth)
+
+        formula = memo.get('isop', signature) if memo is not None else None
+        if formula is None:
+            cubes, cover = isop(truth, truth, n, cubes_memo)
+            formula = sop_formula(cubes)
+            if memo is not None:
+                memo.put('isop', signature, formula)
         f1.write(formula)
 
     f1.write('endmodule\n\n')
@@ -322,7 +871,7 @@ def create_h(m, k, H, f1, modulename):
 
 
 
-def create_wh(n, m, k, W, H, fname, modulename, output_dir, abc, formula_file):
+def create_wh(n, m, k, W, H, fname, modulename, output_dir, abc, formula_file, samples=None, w_synth='abc', memo=None):
     f1=open(fname+'_approx_k='+str(k)+'.v','w')
     f1.write('module ' +modulename+'(' + v2w_top('pi', n)+', '+ v2w_top('po', m)+');\n')
     f1.write('input '+v2w_top('pi', n)+';\n')
@@ -331,9 +880,14 @@ def create_wh(n, m, k, W, H, fname, modulename, output_dir, abc, formula_file):
     f1.write(modulename+'_w'+str(k)+' DUT1 ('+v2w_top('pi', n)+', '+ v2w_top('k', k)+');\n')
     f1.write(modulename+'_h'+str(k)+' DUT2 ('+v2w_top('k', k)+', '+ v2w_top('po', m)+');\n')
     f1.write('endmodule\n\n')
-    create_w(n, k, W, f1, modulename, formula_file, abc)
+    if samples is not None:
+        create_w_sampled(n, k, W, samples, f1, modulename)
+    elif w_synth == 'isop':
+        create_w_isop(n, k, W, f1, modulename, memo)
+    else:
+        create_w(n, k, W, f1, modulename, formula_file, abc, memo)
     create_h(m, k, H, f1, modulename)
-    f1.close
+    f1.close()
 
 def approximate(inputfile, k, worker, i, output_name=None):
 
@@ -341,15 +895,66 @@ def approximate(inputfile, k, worker, i, output_name=None):
     if output_name is None:
         output_name = modulename
 
-    BMF( inputfile+'.truth', k, True)
-    W = np.loadtxt(inputfile + '.truth_w_' + str(k), dtype=int)
-    H = np.loadtxt(inputfile + '.truth_h_' + str(k), dtype=int)
+    # Partitions above 16 inputs were factorized on sampled rows only
+    samples = None
+    if worker.input_list[i] > 16:
+        samples = read_samples(os.path.join(worker.output, 'partition', modulename + '.sample'))
+
+    cache = worker.factor_cache
+    factors = None
+    if cache is not None:
+        # The parallel sweep gives the same factorization as full. The
+        # backend is keyed as the dense one is exact only while
+        # col + log2(row) <= 53, and a run over all degrees as its adaptive
+        # sweep prunes on the largest degree.
+        truth = get_matrix(inputfile + '.truth')
+        sweep = 'full' if worker.bmf_sweep == 'parallel' else worker.bmf_sweep
+        degrees = max(k, worker.output_list[i] - 1) if worker.bmf_all_degrees else None
+        settings = ('binary', sweep, worker.bmf_backend, degrees)
+        factor_key = cache.factor_key(truth, k, settings)
+        factors = cache.get_factors(factor_key)
+
+    if factors is not None:
+        pass
+    elif worker.bmf_all_degrees:
+        # One factorization run covers every degree of this partition and
+        # is stored for later requests
+        factors = load_factorization(inputfile + '.truth', k)
+        if factors is None:
+            max_k = max(k, worker.output_list[i] - 1)
+            all_factors = BMF_all_degrees(inputfile+'.truth', max_k, True, worker.bmf_backend, worker.bmf_sweep, worker.bmf_cpu)
+            factors = all_factors[k]
+            if cache is not None:
+                for d in all_factors:
+                    cache.put_factors(cache.factor_key(truth, d, settings), *all_factors[d])
+    else:
+        factors = factorize(inputfile+'.truth', k, True, worker.bmf_backend, worker.bmf_sweep, worker.bmf_cpu)
+        if cache is not None:
+            cache.put_factors(factor_key, *factors)
+    W, H, WH = factors
+
+    # Truth table of the approximate partition, looked up by the LUT engine
+    write_truth(WH, inputfile + '.truth_wh_' + str(k), worker.truth_format)
+
     formula_file = os.path.join(worker.output, 'bmf_partition', modulename, modulename+'_formula.v')
-    if k == 1:
-        W = W.reshape((W.size, 1))
-        H = H.reshape((1, H.size))
+    approx_file = inputfile + '_approx_k=' + str(k) + '.v'
+
+    if cache is None:
+        create_wh(worker.input_list[i], worker.output_list[i], k, W, H, inputfile, output_name, worker.output, worker.path['abc'], formula_file, samples, worker.w_synth, worker.formula_memo)
+        return W, H, WH
+
+    verilog_key = cache.verilog_key(factor_key, (worker.input_list[i], worker.output_list[i], worker.w_synth), samples)
+    text = cache.get_verilog(verilog_key, output_name, k)
+    if text is None:
+        create_wh(worker.input_list[i], worker.output_list[i], k, W, H, inputfile, output_name, worker.output, worker.path['abc'], formula_file, samples, worker.w_synth, worker.formula_memo)
+        with open(approx_file) as f:
+            cache.put_verilog(verilog_key, output_name, f.read())
+        cache.evict()
+    else:
+        with open(approx_file, 'w') as f:
+            f.write(text)
 
-    create_wh(worker.input_list[i], worker.output_list[i], k, W, H, inputfile, output_name, worker.output, worker.path['abc'], formula_file)
+    return W, H, WH
 
 
 
@@ -361,7 +966,8 @@ def number_of_cell(input_file, yosys):
             + 'synth -flatten; opt; opt_clean -purge; opt; opt_clean -purge; stat;\n'
     num_cell = 0
     output_file = input_file[:-2] + '_syn.log'
-    line=subprocess.call(yosys+" -p \'"+ yosys_command+"\' > "+ output_file, shell=True)
+    with open(output_file, 'w') as f:
+        toolcache.call([yosys, '-p', yosys_command], [input_file], stdout=f)
     with open(output_file, 'r') as file_handle:
         for line in file_handle:
             if 'Number of cells:' in line:
@@ -376,7 +982,7 @@ def write_aiger(input_file, yosys, output_file, map_file):
     '''
     yosys_command = 'read_verilog ' + input_file + '; synth -flatten; opt; opt_clean -purge; abc -g NAND; aigmap; opt; opt_clean -purge; write_aiger -vmap '\
             + map_file + ' ' + output_file + ';'
-    subprocess.call([yosys, '-p', yosys_command], stdout=subprocess.DEVNULL)
+    toolcache.call([yosys, '-p', yosys_command], [input_file], [map_file, output_file], stdout=subprocess.DEVNULL)
     # Parse map file and return dict
     # input_map = {}
     # output_map = {}
@@ -440,7 +1046,7 @@ def get_delay(sta, script, liberty, input_file, modulename, output_file):
         f.write('exit')
 
     with open(output_file, 'w') as f:
-        subprocess.call([sta, script],stdout=f)
+        toolcache.call([sta, script], [script, liberty, input_file], stdout=f)
 
     with open(output_file) as f:
         line = f.readline()
@@ -465,7 +1071,7 @@ def get_power(sta, script, liberty, input_file, modulename, output_file, delay):
         f.write('exit')
 
     with open(output_file, 'w') as f:
-        subprocess.call([sta, script], stdout=f)
+        toolcache.call([sta, script], [script, liberty, input_file], stdout=f)
 
     with open(output_file) as f:
         line = f.readline()
@@ -480,10 +1086,18 @@ def get_power(sta, script, liberty, input_file, modulename, output_file, delay):
 
 
 
+def flatten_command(inp, out):
+    '''
+    Yosys command that flattens a design to write its ports, the same for
+    every caller so that the tool cache shares the run
+    '''
+    return 'read_verilog ' + inp + '; synth -flatten; opt; opt_clean; write_verilog ' + out + ';\n'
+
+
 def create_wrapper(inp, out, top, vmap, worker):
     tmp = os.path.join(worker.output, 'tmp.v')
-    yosys_command = 'read_verilog ' + inp + '; synth -flatten; opt; opt_clean;  write_verilog ' + tmp + ';\n'
-    subprocess.call([worker.path['yosys'], '-p', yosys_command], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    yosys_command = flatten_command(inp, tmp)
+    toolcache.call([worker.path['yosys'], '-p', yosys_command], [inp], [tmp], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
     out_file = open(out, 'w')
 
@@ -620,8 +1234,8 @@ def create_wrapper(inp, out, top, vmap, worker):
 def create_wrapper_single(inp, out, worker):
 
     tmp = os.path.join(worker.output, 'tmp.v')
-    yosys_command = 'read_verilog ' + inp + '; synth -flatten; opt; opt_clean; write_verilog ' + tmp + ';\n'
-    subprocess.call([worker.path['yosys'], '-p', yosys_command], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    yosys_command = flatten_command(inp, tmp)
+    toolcache.call([worker.path['yosys'], '-p', yosys_command], [inp], [tmp], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
     out_file = open(out, 'w')
 
@@ -682,8 +1296,8 @@ def create_wrapper_single(inp, out, worker):
 def module_info(fname, yosys_path):
 
     tmp = time.strftime('%Y_%m_%d-%H_%m_%s') + '.v'
-    yosys_command = 'read_verilog ' + fname + '; synth -flatten; opt; opt_clean; write_verilog ' + tmp + ';\n'
-    subprocess.call([yosys_path, '-p', yosys_command], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    yosys_command = flatten_command(fname, tmp)
+    toolcache.call([yosys_path, '-p', yosys_command], [fname], [tmp], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
     tmp_file = open(tmp)
     inp = {}
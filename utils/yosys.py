@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import threading
+import subprocess
+
+# A yosys process kept alive for the whole life of a (pool) process and fed
+# commands on stdin, so that yosys starts once and every Verilog file is
+# parsed once. Each file is read into a saved design (design -save), and a
+# candidate is assembled by copying the saved designs of its files into an
+# empty one before synthesis.
+
+
+class YosysError(Exception):
+    pass
+
+
+class YosysSession():
+    '''
+    Interactive yosys driven over stdin. The output of a batch of commands
+    ends with a marker printed by the log command. A batch that prints no
+    marker within timeout seconds kills yosys.
+    '''
+    def __init__(self, yosys, timeout=3600):
+        self.proc = subprocess.Popen([yosys, '-Q'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        self.slots = {}
+        self.count = 0
+        self.timeout = timeout
+        # Lines are read by a thread so that waiting for them can time out
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put(line)
+        # End of output
+        self.lines.put(None)
+
+
+    def run(self, commands):
+        '''
+        Run commands and return the lines they printed
+        '''
+        self.count += 1
+        marker = 'BLASYS_DONE_{}'.format(self.count)
+        try:
+            self.proc.stdin.write('\n'.join(commands + ['log ' + marker]) + '\n')
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise YosysError('yosys is not running ({})'.format(e))
+
+        lines = []
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                self.proc.kill()
+                self.proc.wait()
+                raise YosysError('yosys did not answer in {} seconds'.format(self.timeout))
+            if line is None:
+                raise YosysError('yosys exited')
+            # The marker may follow the prompt on the same line, without
+            # readline, and the log command itself may be echoed
+            text = line.strip()
+            if text.endswith(marker) and not text.endswith('log ' + marker):
+                break
+            lines.append(line)
+        for line in lines:
+            if line.startswith('ERROR:') or '> ERROR:' in line:
+                raise YosysError(line.strip())
+        return lines
+
+
+    def slot(self, path):
+        '''
+        Name of the saved design holding the modules of a Verilog file,
+        read again if the file changed
+        '''
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError as e:
+            raise YosysError(str(e))
+        if path not in self.slots or self.slots[path][0] != mtime:
+            name = 'blasys_{}'.format(self.count)
+            self.run(['design -reset', 'read_verilog ' + path, 'proc', 'design -save ' + name])
+            self.slots[path] = (mtime, name)
+        return self.slots[path][1]
+
+
+    def synth(self, verilog_list, commands):
+        '''
+        Run commands on the design made of the modules of verilog_list
+        '''
+        slots = [self.slot(path) for path in verilog_list]
+        return self.run(['design -reset'] + ['design -copy-from {} *'.format(s) for s in slots] + commands)
+
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+
+
+_sessions = {}
+
+
+def session(yosys):
+    '''
+    YosysSession of the current process. Forked pool workers start their
+    own, since the pipes of the parent cannot be shared.
+    '''
+    key = (os.getpid(), yosys)
+    # Start again after yosys exited or was killed
+    if key not in _sessions or _sessions[key].proc.poll() is not None:
+        _sessions[key] = YosysSession(yosys)
+    return _sessions[key]